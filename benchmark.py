@@ -0,0 +1,404 @@
+# Python Prompter benchmarks
+# By: GuizzyQC
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import tiktoken
+
+from bs4 import BeautifulSoup
+
+import pyprompt
+
+parser = argparse.ArgumentParser(description='Python Prompter benchmarks')
+parser.add_argument('--suite', choices=['truncation', 'connections', 'extraction', 'startup', 'paths'], default='truncation',
+                help='select the benchmark to run')
+parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 300000, 1000000],
+                help='approximate input sizes in tokens')
+parser.add_argument('--max_tokens', type=int, default=15000,
+                help='token budget to truncate to')
+parser.add_argument('--page_sizes', type=int, nargs='+', default=[100000, 1000000, 5000000],
+                help='approximate page sizes in bytes')
+parser.add_argument('--url', type=str, default="https://api.openai.com/v1/models",
+                help='enter the address to time requests against')
+parser.add_argument('--requests', type=int, default=20,
+                help='enter the number of requests to time')
+parser.add_argument('--runs', type=int, default=5,
+                help='enter the number of startup runs to take the median of')
+parser.add_argument('--help_budget', type=float, default=60,
+                help='enter the import time budget in ms for pyprompt.py --help')
+parser.add_argument('--prompt_budget', type=float, default=300,
+                help='enter the import time budget in ms for a plain prompt')
+parser.add_argument('--paths', nargs='+', choices=['single', 'streaming', 'search', 'interactive', 'model'], default=['single', 'streaming', 'search', 'interactive', 'model'],
+                help='select the ways of answering prompts to time')
+parser.add_argument('--latency', type=float, default=0.05,
+                help='enter the seconds the stand-in endpoint waits before its first token')
+parser.add_argument('--token_rate', type=float, default=200,
+                help='enter the tokens per second the stand-in endpoint generates')
+parser.add_argument('--answer_tokens', type=int, default=100,
+                help='enter the number of tokens in each answer of the stand-in endpoint')
+parser.add_argument('--page_bytes', type=int, default=100000,
+                help='enter the size in bytes of the pages served to searches')
+parser.add_argument('--load_seconds', type=float, default=0.5,
+                help='enter the seconds the stand-in endpoint takes to load a model')
+parser.add_argument('--interactive_prompts', type=int, default=5,
+                help='enter the number of prompts typed in each interactive run')
+parser.add_argument('--save', type=str,
+                help='enter file to save the results of the paths suite to')
+parser.add_argument('--compare', type=str,
+                help='enter file of earlier paths suite results to compare against')
+parser.add_argument('--skip_legacy', action='store_true',
+                help='only time the current truncation engine')
+
+words = ["the", "model", "context", "search", "result", "page", "token", "prompt", "answer", "paragraph", "café", "naïve", "漢字", "1984", "--", "\n"]
+
+# Build a text of roughly the requested number of tokens, mixing in multi-byte characters so cuts can land inside them
+def make_text(tokens):
+    rng = random.Random(tokens)
+    return " ".join(rng.choice(words) for _ in range(tokens))
+
+# The truncation loop as it was before the single-encode engine, kept here for comparison
+def legacy_trim_to_max_tokens(string, maximum, reverse=False):
+    def count_token(string):
+        token_counter = tiktoken.get_encoding("cl100k_base")
+        return len(token_counter.encode(string))
+    if count_token(string) > maximum:
+        while count_token(string) > maximum:
+            step = 100
+            if (count_token(string) - maximum) > 10000:
+                step = 10000
+            if (count_token(string) - maximum) > 100000:
+                step = 10000
+            if (count_token(string) - maximum) > 300000:
+                step = 100000
+            new_length = len(string) - step
+            if reverse:
+                string = string[new_length:]
+            else:
+                string = string[:new_length]
+    return string
+
+def timed(function, *arguments):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*arguments)
+    return result, time.perf_counter() - start
+
+def benchmark_truncation(sizes, maximum, skip_legacy=False):
+    # Load the encoder up front so neither side pays for the first load
+    pyprompt.get_token_encoder()
+    print("%10s %8s %12s %12s %8s" % ("tokens", "mode", "legacy (s)", "engine (s)", "speedup"))
+    for size in sizes:
+        text = make_text(size)
+        actual = pyprompt.count_tokens(text)
+        for reverse in (False, True):
+            result, engine_time = timed(pyprompt.trim_to_max_tokens, text, maximum, reverse)
+            if pyprompt.count_tokens(result) > maximum:
+                print("Engine exceeded the budget for " + str(actual) + " tokens")
+            if skip_legacy:
+                print("%10d %8s %12s %12.3f %8s" % (actual, "tail" if reverse else "head", "-", engine_time, "-"))
+                continue
+            result, legacy_time = timed(legacy_trim_to_max_tokens, text, maximum, reverse)
+            print("%10d %8s %12.3f %12.3f %7.1fx" % (actual, "tail" if reverse else "head", legacy_time, engine_time, legacy_time / engine_time))
+
+# Time the same GET with a new connection per request, as before pooling, and through the shared keep-alive session
+def benchmark_connections(url, count):
+    def run(get):
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                get(url, timeout=(pyprompt.connect_timeout, 30)).content
+            except requests.RequestException as e:
+                print(f"Error requesting {url}: {str(e)}")
+                return None
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        return latencies
+    print("%10s %12s %12s %12s" % ("client", "mean (ms)", "p50 (ms)", "p95 (ms)"))
+    for name, get in (("bare", requests.get), ("pooled", pyprompt.get_session('api').get)):
+        latencies = run(get)
+        if latencies:
+            print("%10s %12.1f %12.1f %12.1f" % (name, 1000 * sum(latencies) / count, 1000 * latencies[count // 2], 1000 * latencies[int(count * 0.95) - 1]))
+
+# Build an HTML page of roughly the requested size, with paragraphs buried among scripts, tables and links
+def make_page(size):
+    rng = random.Random(size)
+    parts = ["<html><head><meta name=\"description\" content=\"benchmark page\"><script>var x = 1;</script></head><body>"]
+    length = len(parts[0])
+    while length < size:
+        sentence = " ".join(rng.choice(words) for _ in range(40))
+        part = "<div class=\"row\"><p>" + sentence + " <a href=\"#\">link</a></p><table><tr><td>cell</td><td>cell</td></tr></table></div>"
+        parts.append(part)
+        length += len(part)
+    parts.append("</body></html>")
+    return "".join(parts)
+
+# Time paragraph extraction with a full BeautifulSoup tree, as before, against the incremental extractor reading the whole page
+def benchmark_extraction(sizes):
+    def soup_paragraphs(page):
+        soup = BeautifulSoup(page, "html.parser")
+        return "\n".join(p.get_text() for p in soup.find_all("p"))
+    def extractor_paragraphs(page):
+        extractor = pyprompt.PageTextExtractor()
+        for start in range(0, len(page), 65536):
+            extractor.feed(page[start:start + 65536])
+        return "\n".join(extractor.paragraphs)
+    print("%10s %12s %12s %8s" % ("bytes", "soup (s)", "engine (s)", "speedup"))
+    for size in sizes:
+        page = make_page(size)
+        expected, soup_time = timed(soup_paragraphs, page)
+        result, engine_time = timed(extractor_paragraphs, page)
+        if result != expected:
+            print("Extractor output differs for " + str(size) + " bytes")
+        print("%10d %12.3f %12.3f %7.1fx" % (len(page), soup_time, engine_time, soup_time / engine_time))
+
+# A stand-in for an OpenAI-compatible text-generation-webui endpoint and a Searx instance on one local server. Answers start after server.latency seconds and are generated at server.token_rate tokens per second, streamed or whole, searches point at pages of server.page_bytes bytes on the same server, and loading a model takes server.load_seconds. Every answer sent in full is counted in server.answers.
+class MockEndpointHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *arguments):
+        pass
+
+    def send_json(self, value):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?")[0]
+        if path == "/internal/model/info":
+            self.send_json({'model_name': server.model})
+        elif path == "/internal/model/list":
+            self.send_json({'model_names': ["bench-model-a", "bench-model-b"]})
+        elif path == "/models":
+            self.send_json({'data': [{'id': server.model}]})
+        elif path == "/search":
+            base = "http://127.0.0.1:" + str(server.server_port)
+            self.send_json({
+                'results': [{'url': base + "/page/" + str(i), 'title': "Page " + str(i), 'content': "", 'engine': "mock"} for i in range(10)],
+                'infoboxes': [],
+                'answers': [],
+            })
+        elif path.startswith("/page/"):
+            body = server.page.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+        if self.path == "/internal/model/load":
+            time.sleep(server.load_seconds)
+            server.model = request.get('model_name', server.model)
+            self.send_json({'status': 'ok'})
+            return
+        time.sleep(server.latency)
+        answer = [words[i % len(words)] for i in range(server.answer_tokens)]
+        if not request.get('stream'):
+            time.sleep(server.answer_tokens / server.token_rate)
+            text = " ".join(answer)
+            self.send_json({'model': server.model, 'choices': [{'text': text, 'message': {'role': 'assistant', 'content': text}}], 'usage': {'completion_tokens': server.answer_tokens}})
+            self.count_answer()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for word in answer:
+            self.send_chunk(b"data: " + json.dumps({'choices': [{'text': word + " ", 'delta': {'content': word + " "}}]}).encode('utf-8') + b"\n\n")
+            time.sleep(1 / server.token_rate)
+        self.send_chunk(b"data: " + json.dumps({'choices': [], 'usage': {'completion_tokens': server.answer_tokens}}).encode('utf-8') + b"\n\n")
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+        self.count_answer()
+
+    def count_answer(self):
+        with self.server.answers_lock:
+            self.server.answers += 1
+
+def start_mock_endpoint(latency=0, token_rate=1000000, answer_tokens=1, page_bytes=1000, load_seconds=0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockEndpointHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.token_rate = token_rate
+    server.answer_tokens = answer_tokens
+    server.page = make_page(page_bytes)
+    server.load_seconds = load_seconds
+    server.model = "bench-model-a"
+    server.answers = 0
+    server.answers_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Run pyprompt.py in an environment of its own, pointed at the stand-in, without any settings of the user.
+def pyprompt_environment(server, extra=None):
+    environment = {key: value for key, value in os.environ.items() if not key.startswith("PYPROMPT_") and not key.startswith("OPENAI_")}
+    environment['OPENAI_API_BASE'] = "http://127.0.0.1:" + str(server.server_port)
+    environment['PYPROMPT_SOCKET'] = os.path.join(tempfile.gettempdir(), "pyprompt-benchmark-none.sock")
+    environment.update(extra or dict())
+    return environment
+
+# Total the self time of every import reported by -X importtime, in ms
+def import_time(stderr):
+    return sum(int(match) for match in re.findall(r"^import time:\s+(\d+) \|", stderr, re.MULTILINE)) / 1000
+
+def measure_startup(arguments, environment, runs):
+    imports = []
+    walls = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime"] + arguments, env=environment, capture_output=True, text=True)
+        walls.append(time.perf_counter() - start)
+        imports.append(import_time(result.stderr))
+    imports.sort()
+    walls.sort()
+    return imports[runs // 2], 1000 * walls[runs // 2]
+
+# Time the imports of pyprompt.py for --help and for a plain prompt answered by a local stand-in, minus what the bare interpreter imports, and fail when either goes over its budget
+def benchmark_startup(runs, help_budget, prompt_budget):
+    server = start_mock_endpoint()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pyprompt.py")
+    environment = pyprompt_environment(server)
+    baseline, baseline_wall = measure_startup(["-c", "pass"], environment, runs)
+    over_budget = False
+    print("%12s %14s %12s %12s" % ("run", "imports (ms)", "budget (ms)", "wall (ms)"))
+    for name, arguments, budget in (("--help", [script, "--help"], help_budget), ("prompt", [script, "--no_daemon", "hello"], prompt_budget)):
+        imports, wall = measure_startup(arguments, environment, runs)
+        imports -= baseline
+        print("%12s %14.1f %12.1f %12.1f" % (name, imports, budget, wall))
+        if imports > budget:
+            over_budget = True
+    server.shutdown()
+    if over_budget:
+        print("Startup is over budget")
+        sys.exit(1)
+
+# Run pyprompt.py once with the given arguments and input, and return its wall time, CPU time and peak memory, taken from the resource usage of that process alone, and whether it succeeded. pyprompt.py reports most errors and still exits with 0, so a run that printed an error fails too.
+def run_pyprompt(arguments, environment, stdin=""):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pyprompt.py")
+    with tempfile.TemporaryFile() as output:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, script] + arguments, env=environment, stdin=subprocess.PIPE, stdout=output, stderr=subprocess.PIPE)
+        process.stdin.write(stdin.encode('utf-8'))
+        process.stdin.close()
+        errors = process.stderr.read().decode('utf-8', 'replace')
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        process.stderr.close()
+        output.seek(0)
+        printed = output.read().decode('utf-8', 'replace')
+    failure = None
+    if process.returncode != 0:
+        failure = errors.strip().splitlines()[-1] if errors.strip() else "exited with " + str(process.returncode)
+    else:
+        failure = next((line for line in printed.splitlines() if line.startswith("Error")), None)
+    if failure:
+        print("pyprompt.py " + " ".join(arguments) + " failed: " + failure)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = usage.ru_maxrss / 1024 if sys.platform != "darwin" else usage.ru_maxrss / 1048576
+    return wall, usage.ru_utime + usage.ru_stime, peak, failure is None
+
+# Time answering prompts end to end in each way pyprompt.py can, against the stand-in: a single prompt, the same streamed, with search results fetched for it, several typed in the interactive prompt, and with a model to load first. Each path is run the given number of times and reported with its median and 95th percentile latency, prompts per second, CPU time and peak memory. A path fails, and isn't timed, as soon as a run reports an error or the stand-in didn't send every answer it asked for; the suite then exits with an error. Results can be saved, and compared with saved ones.
+def benchmark_paths(paths, runs, latency, token_rate, answer_tokens, page_bytes, load_seconds, interactive_prompts, save=None, compare=None):
+    server = start_mock_endpoint(latency, token_rate, answer_tokens, page_bytes, load_seconds)
+    base = "http://127.0.0.1:" + str(server.server_port)
+    cases = {
+        'single': (["--no_daemon", "Tell me a story"], dict(), "", 1),
+        'streaming': (["--no_daemon", "--streaming", "Tell me a story"], dict(), "", 1),
+        'search': (["--no_daemon", "--search", "benchmark page", "Tell me about the benchmark page"], {'PYPROMPT_SEARX_URL': base + "/search", 'PYPROMPT_MAX_URLS': "3"}, "", 1),
+        'interactive': (["--direct"], {'PYPROMPT_MODE': "chat", 'PYPROMPT_CHARACTER': "Assistant"}, "Tell me a story\n" * interactive_prompts + "(quit)\n", interactive_prompts),
+        'model': (["--no_daemon", "Tell me a story"], {'PYPROMPT_ENFORCE_MODEL': "y", 'PYPROMPT_MODEL': "bench-model-b"}, "", 1),
+    }
+    previous = dict()
+    if compare:
+        with open(compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    results = dict()
+    failed = []
+    print("%12s %10s %10s %10s %10s %10s %10s" % ("path", "p50 (ms)", "p95 (ms)", "prompts/s", "cpu (ms)", "peak (MB)", "change"))
+    for path in paths:
+        arguments, extra, stdin, prompts = cases[path]
+        environment = pyprompt_environment(server, extra)
+        walls = []
+        cpus = []
+        peaks = []
+        for _ in range(runs):
+            # Every run of the model path has to load the model
+            server.model = "bench-model-a"
+            answers = server.answers
+            wall, cpu, peak, ok = run_pyprompt(arguments, environment, stdin)
+            if ok and server.answers - answers < prompts:
+                print("pyprompt.py " + " ".join(arguments) + " failed: got " + str(server.answers - answers) + " of " + str(prompts) + " answers")
+                ok = False
+            if not ok:
+                break
+            walls.append(wall)
+            cpus.append(cpu)
+            peaks.append(peak)
+        if len(walls) < runs:
+            failed.append(path)
+            print("%12s %10s" % (path, "failed"))
+            continue
+        walls.sort()
+        cpus.sort()
+        result = {
+            'p50': 1000 * walls[runs // 2],
+            'p95': 1000 * walls[max(int(runs * 0.95) - 1, 0)],
+            'prompts_per_second': prompts * runs / sum(walls),
+            'cpu': 1000 * cpus[runs // 2],
+            'peak': max(peaks),
+        }
+        results[path] = result
+        change = "-"
+        if path in previous:
+            change = "%+.1f%%" % (100 * (result['p50'] - previous[path]['p50']) / previous[path]['p50'])
+        print("%12s %10.1f %10.1f %10.2f %10.1f %10.1f %10s" % (path, result['p50'], result['p95'], result['prompts_per_second'], result['cpu'], result['peak'], change))
+    server.shutdown()
+    if save:
+        with open(save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+    if failed:
+        print("Paths failed: " + ", ".join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.suite == 'truncation':
+        benchmark_truncation(args.sizes, args.max_tokens, args.skip_legacy)
+    if args.suite == 'connections':
+        benchmark_connections(args.url, args.requests)
+    if args.suite == 'extraction':
+        benchmark_extraction(args.page_sizes)
+    if args.suite == 'startup':
+        benchmark_startup(args.runs, args.help_budget, args.prompt_budget)
+    if args.suite == 'paths':
+        benchmark_paths(args.paths, args.runs, args.latency, args.token_rate, args.answer_tokens, args.page_bytes, args.load_seconds, args.interactive_prompts, args.save, args.compare)
@@ -2,23 +2,109 @@
 # By: GuizzyQC
 
 import argparse
-import requests
+import codecs
+import contextvars
+import functools
+import html.parser
+import io
 import json
+import math
 import os
-import io
 import sys
+import tempfile
 import re
-import shlex 
-import sseclient
-import tiktoken
-
-from bs4 import BeautifulSoup
+import signal
+import threading
+import time
 
-printer_target = "/tmp/DEVTERM_PRINTER_IN"
+printer_queue = None
+printer_queue_size = 256
+printer_lock = threading.Lock()
+printer_flush_timeout = 30
 max_text_length = 999999
+token_encoding = "cl100k_base"
+token_encoder = None
+history_tail = 200
+message_token_overhead = 4
+history_block_size = 65536
+history_lock = threading.RLock()
+history_compactor = None
+history_keep_turns = 4
+history_summary_question = "Summarize our conversation so far."
+history_summary_system = "You summarize conversations. Write a concise summary of the conversation you are given, keeping the facts, decisions, names and open questions needed to carry it on, in the same language."
+model_state = dict()
+model_state_ttl = 300
+model_lock = threading.Lock()
+model_locks = dict()
+backends = dict()
+backends_lock = threading.Lock()
+backend_checker = None
+backend_retry_interval = 5
+backend_max_retry_interval = 300
+max_retry_backoff = 30
+retryable_statuses = (429, 500, 502, 503, 504)
+hedge_min_samples = 20
+first_byte_latencies = []
+max_latency_samples = 200
+http_sessions = dict()
+http_sessions_lock = threading.Lock()
+http_pool_size = int(os.environ.get("PYPROMPT_POOL_SIZE") or 10)
+response_stats = dict()
+event_loop = None
+event_loop_lock = threading.Lock()
+daemon_socket = os.environ.get("PYPROMPT_SOCKET") or os.path.join(tempfile.gettempdir(), "pyprompt-" + str(os.getuid() if hasattr(os, 'getuid') else os.environ.get("USERNAME", "user")) + ".sock")
+daemon_lock = threading.Lock()
+loaded_histories = dict()
+cache_file = None
+pdf_spool_bytes = 1048576
+max_chars_per_token = 6
+passage_chars = 1000
+bm25_k1 = 1.5
+bm25_b = 0.75
+text_content_types = ["application/xhtml+xml", "application/xml", "application/json"]
+cache_connection = None
+cache_lock = threading.Lock()
+cache_stats = dict()
+cache_search_ttl = 3600
+metrics_output = None
+metrics_record = None
+metrics_started = 0
+metrics_totals = dict()
+metrics_lock = threading.Lock()
+metrics_served = False
+metrics_counters = ['bytes_fetched', 'tokens_in', 'tokens_out']
+metrics_gauges = ['ttft', 'tokens_per_second']
+metrics_muted = contextvars.ContextVar('metrics_muted', default=False)
+capabilities_ttl = 86400
+capabilities_lock = threading.Lock()
+fanout_lock = threading.Lock()
 banner = "*************************\nWelcome to PythonPrompter\n*************************\nType (quit) at the main prompt to exit\nType (search:search term) at the start of a prompt to feed search results\nType (continue) to continue previous answer\n"
 
-default = dict()
+# The settings read from PYPROMPT_ variables outside of load_defaults. They are read at startup and again for every prompt the daemon answers, so each prompt follows the environment it was sent from.
+def load_environment():
+    global printer_target, continue_tokens, history_summary_tokens, backend_check_interval, request_retries, retry_backoff, hedge_requests, hedge_delay, connect_timeout, read_timeout, stream_flush_interval, fetch_workers, fetch_deadline, max_page_bytes, max_pdf_bytes, cache_page_ttl, cache_response_ttl, cache_max_bytes, capabilities_file
+    printer_target = os.environ.get("PYPROMPT_PRINTER_TARGET") or "/tmp/DEVTERM_PRINTER_IN"
+    continue_tokens = int(os.environ.get("PYPROMPT_CONTINUE_TOKENS") or 1024)
+    history_summary_tokens = int(os.environ.get("PYPROMPT_HISTORY_SUMMARY_TOKENS") or 0)
+    backend_check_interval = float(os.environ.get("PYPROMPT_HEALTH_INTERVAL") or 30)
+    request_retries = int(os.environ.get("PYPROMPT_RETRIES") or 2)
+    retry_backoff = float(os.environ.get("PYPROMPT_RETRY_BACKOFF") or 0.5)
+    hedge_requests = (os.environ.get("PYPROMPT_HEDGE") or "n").lower() == "y"
+    hedge_delay = float(os.environ.get("PYPROMPT_HEDGE_DELAY") or 10)
+    connect_timeout = float(os.environ.get("PYPROMPT_CONNECT_TIMEOUT") or 5)
+    read_timeout = float(os.environ.get("PYPROMPT_READ_TIMEOUT") or 3600)
+    stream_flush_interval = float(os.environ.get("PYPROMPT_FLUSH_INTERVAL") or 0.05)
+    fetch_workers = int(os.environ.get("PYPROMPT_FETCH_WORKERS") or 4)
+    fetch_deadline = float(os.environ.get("PYPROMPT_FETCH_DEADLINE") or 15)
+    max_page_bytes = int(os.environ.get("PYPROMPT_MAX_PAGE_BYTES") or 2097152)
+    max_pdf_bytes = int(os.environ.get("PYPROMPT_MAX_PDF_BYTES") or 20971520)
+    cache_page_ttl = float(os.environ.get("PYPROMPT_CACHE_TTL") or 86400)
+    cache_response_ttl = float(os.environ.get("PYPROMPT_RESPONSE_CACHE_TTL") or 86400)
+    cache_max_bytes = int(float(os.environ.get("PYPROMPT_CACHE_SIZE") or 100) * 1024 * 1024)
+    capabilities_file = os.environ.get("PYPROMPT_ENDPOINTS_FILE") or os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "pyprompt-endpoints.json")
+
+load_environment()
+
 history = []
 
 parser = argparse.ArgumentParser(description='OpenAI API Prompter')
@@ -32,6 +118,10 @@ parser.add_argument('--enforce', action='store_true',
                 help='force model loading')
 parser.add_argument('--no_enforce', action='store_true',
                 help='disable model loading')
+parser.add_argument('--preload', action='store_true',
+                help='load the model in the background at startup')
+parser.add_argument('--backends', type=str,
+                help='enter the endpoints to spread prompts over, as url|models|presets separated by ;')
 parser.add_argument('--model', type=str,
                 help='enter model to load')
 parser.add_argument('--streaming', action='store_true',
@@ -60,38 +150,260 @@ parser.add_argument('--search', type=str, action='append',
                 help='enter search terms to find')
 parser.add_argument('--max_tokens', type=int, choices=range(1, 200000),
                 help='enter the maximum number of tokens in the context')
+parser.add_argument('--response_tokens', type=int,
+                help='enter the maximum number of tokens in an answer')
+parser.add_argument('--context_tokens', type=int,
+                help='enter the size of the model context window in tokens')
 parser.add_argument('--max_urls', type=int, choices=range(1, 11),
                 help='enter the number of search results or the maximum number of urls to read')
+parser.add_argument('--cache', type=str,
+                help='enter cache file to keep fetched pages and search results in')
+parser.add_argument('--response_cache', choices=['y', 'n', 'always'],
+                help='select whether answers are kept in the cache file and reused for the same request')
+parser.add_argument('--cache_stats', action='store_true',
+                help='show cache statistics and exit')
+parser.add_argument('--batch', type=str,
+                help='enter JSONL file of prompts to run, or - for stdin')
+parser.add_argument('--concurrency', type=int, default=4,
+                help='enter the number of batch prompts, or fan-out prompts per endpoint, to run at the same time')
+parser.add_argument('--order', choices=['input', 'completion'], default='input',
+                help='select the order batch results are written in')
+parser.add_argument('--output', type=str,
+                help='enter JSONL file to write batch or fan-out results to')
+parser.add_argument('--resume', action='store_true',
+                help='skip batch prompts already answered in the output file')
+parser.add_argument('--fanout', type=str,
+                help='enter the endpoints, models and presets to compare the prompt or batch file on, as url|models|presets separated by ;')
+parser.add_argument('--daemon', action='store_true',
+                help='run in the background and answer prompts from later invocations')
+parser.add_argument('--no_daemon', action='store_true',
+                help='answer the prompt in-process even if a daemon is running')
+parser.add_argument('--metrics', type=str,
+                help='enter file to write the timing of each prompt to as JSON lines, or - for stderr')
+parser.add_argument('--metrics_port', type=int,
+                help='enter port to serve metrics on in Prometheus format when running interactively or as a daemon')
 parser.add_argument('--printer', action='store_true', help=argparse.SUPPRESS)
 parser.add_argument('rest', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
 
-args = parser.parse_args()
-
-default['url'] = os.environ.get("OPENAI_API_BASE") or "https://api.openai.com/v1"
-default['api_key'] = os.environ.get("OPENAI_API_KEY") or ""
-default['model'] = (os.environ.get("PYPROMPT_MODEL") or "n")
-default['mode'] = (os.environ.get("PYPROMPT_MODE") or "instruct").lower()
-default['preset'] = os.environ.get("PYPROMPT_PRESET") or "Divine Intellect"
-default['instruct_template'] = os.environ.get("PYPROMPT_INSTRUCT_TEMPLATE") or ""
-default['character'] = os.environ.get("PYPROMPT_CHARACTER") or ""
-default['system'] = os.environ.get("PYPROMPT_SYSTEM") or "You are a helpful assistant, answer any request from the user."
-default['enforce'] = (os.environ.get("PYPROMPT_ENFORCE_MODEL") or "n").lower()
-default['streaming'] = (os.environ.get("PYPROMPT_STREAMING") or "n").lower()
-default['history'] = (os.environ.get("PYPROMPT_HISTORY") or "n").lower()
-default['searx_url'] = (os.environ.get("PYPROMPT_SEARX_URL") or "n").lower()
-default['searx_api_key'] = (os.environ.get("PYPROMPT_SEARX_API_KEY") or "n")
-default['max_urls'] = int(os.environ.get("PYPROMPT_MAX_URLS") or 1)
-default['max_tokens'] = int(os.environ.get("PYPROMPT_MAX_TOKENS") or 15000)
-default['printer'] = (os.environ.get("PYPROMPT_PRINTER") or "n").lower()
-
-
-# This function takes an output string and an optional echo parameter (default is 1) and prints the output to the console if echo is True. If the parameter output_to_printer is set to 'y', it also sends the output to a printer specified by the printer variable using the os.system command. 
+# Read the default settings from the environment variables.
+def load_defaults():
+    default = dict()
+    default['url'] = os.environ.get("OPENAI_API_BASE") or "https://api.openai.com/v1"
+    default['api_key'] = os.environ.get("OPENAI_API_KEY") or ""
+    default['backends'] = os.environ.get("PYPROMPT_BACKENDS") or "n"
+    default['model'] = (os.environ.get("PYPROMPT_MODEL") or "n")
+    default['mode'] = (os.environ.get("PYPROMPT_MODE") or "instruct").lower()
+    default['preset'] = os.environ.get("PYPROMPT_PRESET") or "Divine Intellect"
+    default['instruct_template'] = os.environ.get("PYPROMPT_INSTRUCT_TEMPLATE") or ""
+    default['character'] = os.environ.get("PYPROMPT_CHARACTER") or ""
+    default['system'] = os.environ.get("PYPROMPT_SYSTEM") or "You are a helpful assistant, answer any request from the user."
+    default['enforce'] = (os.environ.get("PYPROMPT_ENFORCE_MODEL") or "n").lower()
+    default['preload'] = (os.environ.get("PYPROMPT_PRELOAD_MODEL") or "n").lower()
+    default['streaming'] = (os.environ.get("PYPROMPT_STREAMING") or "n").lower()
+    default['history'] = (os.environ.get("PYPROMPT_HISTORY") or "n").lower()
+    default['searx_url'] = (os.environ.get("PYPROMPT_SEARX_URL") or "n").lower()
+    default['searx_api_key'] = (os.environ.get("PYPROMPT_SEARX_API_KEY") or "n")
+    default['max_urls'] = int(os.environ.get("PYPROMPT_MAX_URLS") or 1)
+    default['max_tokens'] = int(os.environ.get("PYPROMPT_MAX_TOKENS") or 15000)
+    default['context_tokens'] = int(os.environ.get("PYPROMPT_CONTEXT_TOKENS") or 8192)
+    default['response_tokens'] = int(os.environ.get("PYPROMPT_RESPONSE_TOKENS") or 4096)
+    default['cache'] = (os.environ.get("PYPROMPT_CACHE") or "n")
+    default['response_cache'] = (os.environ.get("PYPROMPT_RESPONSE_CACHE") or "n").lower()
+    default['printer'] = (os.environ.get("PYPROMPT_PRINTER") or "n").lower()
+    return default
+
+
+# This function takes an output string and an optional echo parameter (default is 1) and prints the output to the console if echo is True. If the parameter output_to_printer is set to 'y', it also sends the output, as one line, to the printer specified by the printer_target variable. 
 def output_result(string, output_to_printer=False, echo=True):
     if echo:
         print(string)
     if output_to_printer:
-        printer_command = "echo " + shlex.quote(string)
-        os.system(printer_command + " > " + printer_target)
+        send_to_printer(str(string) + "\n")
+
+# The printer is written to by a background thread that keeps printer_target open between outputs, so nothing waits on the slow device. Text to print goes through a queue of printer_queue_size pieces, started on first use, along with the printer_target it was meant for, which is opened instead when it changes; when the printer falls that far behind, new text is dropped rather than holding up the prompt.
+def get_printer_queue():
+    global printer_queue
+    with printer_lock:
+        if printer_queue is None:
+            import atexit
+            import queue
+            printer_queue = queue.Queue(maxsize=printer_queue_size)
+            threading.Thread(target=run_printer, daemon=True).start()
+            atexit.register(flush_printer)
+    return printer_queue
+
+def run_printer():
+    device = None
+    while True:
+        target, text = printer_queue.get()
+        try:
+            if device is not None and device.name != target:
+                device.close()
+                device = None
+            if device is None:
+                device = open(target, 'w', encoding='utf-8')
+            device.write(text)
+            device.flush()
+        except OSError as e:
+            print(f"Error printing: {str(e)}", file=sys.stderr)
+            device = None
+        finally:
+            printer_queue.task_done()
+
+def send_to_printer(text):
+    import queue
+    try:
+        get_printer_queue().put_nowait((printer_target, text))
+    except queue.Full:
+        print("Printer is too far behind, leaving out some output", file=sys.stderr)
+
+# Give the printer up to printer_flush_timeout seconds to finish what is queued before exiting.
+def flush_printer():
+    deadline = time.monotonic() + printer_flush_timeout
+    while printer_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+# Metrics are collected for one prompt at a time, or one batch: how long each stage of answering it took, summed when a stage runs more than once such as for several pages, the bytes fetched, the tokens sent and received, the time to the first token and the generation speed. They are off unless metrics_output is set or a metrics port is served, and cost a global lookup per stage then.
+def configure_metrics(arguments):
+    global metrics_output
+    metrics_output = arguments.metrics or os.environ.get("PYPROMPT_METRICS") or None
+
+def metrics_enabled():
+    return metrics_output is not None or metrics_served
+
+def begin_metrics():
+    global metrics_record, metrics_started
+    if not metrics_enabled():
+        return
+    metrics_record = {'stages': dict()}
+    metrics_started = time.perf_counter()
+
+# The metrics record of the current prompt, or None when metrics are off or muted for background work running alongside it. Muting is set in a context, which the tasks and worker threads of the event loop inherit.
+def current_metrics():
+    if metrics_muted.get():
+        return None
+    return metrics_record
+
+def add_metric(name, value):
+    record = current_metrics()
+    if record is None:
+        return
+    with metrics_lock:
+        record[name] = record.get(name, 0) + value
+
+def set_metric(name, value):
+    record = current_metrics()
+    if record is not None:
+        record[name] = value
+
+# Time a stage into the metrics of the current prompt, as a with block.
+class StageTimer:
+    def __init__(self, stage):
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.record = current_metrics()
+        if self.record is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        record = self.record
+        if record is not None and self.started is not None:
+            with metrics_lock:
+                record['stages'][self.stage] = record['stages'].get(self.stage, 0) + time.perf_counter() - self.started
+
+# Time every call of a function as a stage.
+def metered(stage):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*arguments, **keywords):
+            if current_metrics() is None:
+                return function(*arguments, **keywords)
+            with StageTimer(stage):
+                return function(*arguments, **keywords)
+        return wrapper
+    return decorate
+
+# Finish the metrics of a prompt or batch: write them as a JSON line to metrics_output, and add them to the totals served to Prometheus.
+def finish_metrics(kind):
+    global metrics_record
+    record = metrics_record
+    if record is None:
+        return
+    metrics_record = None
+    record['seconds'] = time.perf_counter() - metrics_started
+    with metrics_lock:
+        metrics_totals['prompts'] = metrics_totals.get('prompts', 0) + 1
+        for stage, seconds in list(record['stages'].items()) + [('total', record['seconds'])]:
+            metrics_totals.setdefault('stages', dict())[stage] = metrics_totals.get('stages', dict()).get(stage, 0) + seconds
+        for name in metrics_counters:
+            metrics_totals[name] = metrics_totals.get(name, 0) + record.get(name, 0)
+        for name in metrics_gauges:
+            if name in record:
+                metrics_totals[name] = record[name]
+    if metrics_output is None:
+        return
+    record['stages'] = {stage: round(seconds, 6) for stage, seconds in record['stages'].items()}
+    line = json.dumps(dict({'time': round(time.time(), 3), 'kind': kind}, **{name: round(value, 6) if isinstance(value, float) else value for name, value in record.items()})) + "\n"
+    try:
+        if metrics_output == "-":
+            sys.stderr.write(line)
+        else:
+            with open(metrics_output, 'a', encoding='utf-8') as f:
+                f.write(line)
+    except OSError as e:
+        print(f"Error writing metrics: {str(e)}", file=sys.stderr)
+
+def format_prometheus_metrics():
+    with metrics_lock:
+        totals = json.loads(json.dumps(metrics_totals))
+    lines = ["# HELP pyprompt_prompts_total Prompts and batches answered.", "# TYPE pyprompt_prompts_total counter", "pyprompt_prompts_total " + str(totals.get('prompts', 0))]
+    lines += ["# HELP pyprompt_stage_seconds_total Time spent in each stage of answering prompts.", "# TYPE pyprompt_stage_seconds_total counter"]
+    for stage, seconds in sorted(totals.get('stages', dict()).items()):
+        lines.append("pyprompt_stage_seconds_total{stage=\"" + stage + "\"} " + str(round(seconds, 6)))
+    for name in metrics_counters:
+        lines += ["# TYPE pyprompt_" + name + "_total counter", "pyprompt_" + name + "_total " + str(totals.get(name, 0))]
+    for name in metrics_gauges:
+        if name in totals:
+            lines += ["# TYPE pyprompt_last_" + name + " gauge", "pyprompt_last_" + name + " " + str(round(totals[name], 6))]
+    return "\n".join(lines) + "\n"
+
+# Serve the metrics totals in the Prometheus text format at /metrics from a background thread, for a process that keeps running.
+def serve_metrics(port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def log_message(self, *arguments):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = format_prometheus_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    global metrics_served
+    metrics_served = True
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+# Return the shared HTTP session for an upstream ('api' for the LLM endpoint, 'searx' for the search instance, 'web' for page downloads), creating it on first use. Each session keeps its connections alive in a pool of http_pool_size, so repeated requests to the same host skip the TCP and TLS handshakes.
+def get_session(name):
+    with http_sessions_lock:
+        session = http_sessions.get(name)
+        if session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[name] = session
+        return session
 
 # Hide a string for display, will only show the length of the string
 def star(string):
@@ -101,7 +413,7 @@ def star(string):
 # It returns a string indicating whether the user wants to change the settings or not. 
 def start_interface(default):
     change_options = "y"
-    os.system('cls||clear')
+    clear_screen()
     print(banner)
     if str(default['url']) != "https://api.openai.com/v1" and str(default['api_key']) != "":
         print("Current settings:")
@@ -136,131 +448,573 @@ def start_interface(default):
         change_options = answer 
     return change_options
 
+# Clear the terminal with an escape sequence instead of starting a shell to run clear every time, except on Windows where cls is used.
+def clear_screen():
+    if os.name == 'nt':
+        os.system('cls')
+    else:
+        sys.stdout.write("\033[H\033[2J\033[3J")
+        sys.stdout.flush()
+
 # This function clears the terminal screen and prints a banner. 
 def reset_screen():
-    if not args.prompt:
-        os.system('cls||clear')
+    if not args.prompt and not args.batch:
+        clear_screen()
         print(banner)
 
-# To summarize the behavior of this function in one line, it loads a model into the system by sending a POST request to the specified URL with the model's settings as JSON data in the request body. The function handles any exceptions that may occur during the request and prints an error message if there is a problem. 
-def enforce_model(settings):
-    try:
-        response = requests.get(settings['url'] + "/internal/model/info", headers=settings['headers'], timeout=15, verify=True)
-        answer_json = response.json()
-        if answer_json["model_name"] != settings['model']:
-            print(">>> Please be patient, changing model to " + str(settings['model']))
-            data = {
-                'model_name': settings['model'],
-                'settings': { "preset": settings['preset'] }
-                }
-            response = requests.post(settings['url'] + "/internal/model/load", headers=settings['headers'], json=data, timeout=60, verify=True)
-    except Exception as e:
-        print(f"Error setting model: {str(e)}")
+# Forget what we know about the model loaded on an endpoint, or on every endpoint, so the next request checks it again.
+def invalidate_model_state(url=None):
+    if url is None:
+        model_state.clear()
+    else:
+        model_state.pop(url, None)
 
-# This function generates an AI response based on the chat history and new question provided. It uses the given settings to determine the behavior of the AI. It first checks if the model is not set to "n" and enforces the model if necessary. Then, it creates a list of messages based on the chat history and new questions. Depending on the mode, it adds either a user or system message to the messages list. Finally, it sends a POST request to the URL with the data and headers, and returns the AI's response message. If there is an error during the process, it prints an error message.
-def generate_ai_response(chat_history, prompt, settings, mode):
-    messages = []
+def model_state_is_current(settings, url=None):
+    state = model_state.get(url or settings['url']) or {}
+    return (state.get('model') == settings['model']
+            and time.monotonic() - state.get('checked', 0) < model_state_ttl)
+
+# Each endpoint loads its model under its own lock, so one endpoint busy loading a model doesn't hold up prompts sent to the others.
+def get_model_lock(url):
+    with model_lock:
+        return model_locks.setdefault(url, threading.Lock())
+
+# To summarize the behavior of this function in one line, it loads a model into the system by sending a POST request to the specified URL with the model's settings as JSON data in the request body. The model last seen loaded on each endpoint is remembered for model_state_ttl seconds, during which the model info request is skipped. The function handles any exceptions that may occur during the request and prints an error message if there is a problem. 
+@metered('model')
+def enforce_model(settings, force=False, url=None):
+    url = url or settings['url']
+    with get_model_lock(url):
+        if not force and model_state_is_current(settings, url):
+            return
+        invalidate_model_state(url)
+        try:
+            response = get_session('api').get(url + "/internal/model/info", headers=settings['headers'], timeout=(connect_timeout, 15), verify=True)
+            answer_json = response.json()
+            if answer_json["model_name"] != settings['model']:
+                print(">>> Please be patient, changing model to " + str(settings['model']))
+                data = {
+                    'model_name': settings['model'],
+                    'settings': { "preset": settings['preset'] }
+                    }
+                response = get_session('api').post(url + "/internal/model/load", headers=settings['headers'], json=data, timeout=(connect_timeout, 60), verify=True)
+                response.raise_for_status()
+            model_state[url] = {'model': settings['model'], 'checked': time.monotonic()}
+        except Exception as e:
+            print(f"Error setting model: {str(e)}")
+
+# Start loading the model in a background thread on the endpoint the next prompt is most likely sent to, so it is ready by the time the first prompt is typed. Requests made before it finishes wait on the model lock.
+def preload_model(settings):
+    if settings['model'] != "n":
+        threading.Thread(target=enforce_model, args=(settings, False, rank_backends(settings)[0]['url']), daemon=True).start()
+
+# This function looks at a response from an endpoint for signs that the model was changed behind our back, an error status or a different model name in the answer, and drops the cached model state if so.
+def check_model_state(response, settings, url=None):
+    url = url or settings['url']
+    if settings['model'] == "n" or url not in model_state:
+        return
+    if response.status_code >= 400:
+        invalidate_model_state(url)
+        return
+    if 'text/event-stream' in response.headers.get('Content-Type', ''):
+        return
     try:
-        if settings['model'] != "n":
-            enforce_model(settings)
-        if mode == "completion":
-            data = {
-                'stream': False,
-                'max_tokens': 4096,
-                'prompt': prompt,
-            }
-            response = requests.post(settings['url'] + "/completions", headers=settings['headers'], json=data, timeout=3600, verify=True)
-            assistant_message = response.json()['choices'][0]['text']
-        if mode == "chat":
-            for question, answer in chat_history:
-                messages.append({"role": "user", "content": question})
-                messages.append({"role": "assistant", "content": answer})
-            messages.append({"role": "user", "content": prompt})
-            data = {
-                'stream': False,
-                'max_tokens': 4096,
-                'messages': messages,
-                'instruction_template': settings['instruct_template'],
-                'mode': 'chat-instruct',
-                'character': settings['character'],
-            }
-            response = requests.post(settings['url'] + "/chat/completions", headers=settings['headers'], json=data, timeout=3600, verify=True)
-            assistant_message = response.json()['choices'][0]['message']['content']
-
-        if mode == "instruct":
-            messages.append({"role": "system", "content": settings['system']})
-            messages.append({"role": "user", "content": prompt})
-            data = {
-                'stream': False,
-                'mode': 'instruct',
-                'instruction_template': settings['instruct_template'],
-                'max_tokens': 4096,
-                'messages': messages,
-            }
-            response = requests.post(settings['url'] + "/chat/completions", headers=settings['headers'], json=data, timeout=3600, verify=True)
-            assistant_message = response.json()['choices'][0]['message']['content']
-        return(assistant_message)
-    except Exception as e:
-        print(f"Error generating response: {str(e)}")
+        served_model = response.json().get('model')
+    except ValueError:
+        return
+    if served_model and served_model != settings['model']:
+        invalidate_model_state(url)
 
-def generate_streaming_response(chat_history, prompt, settings, mode):
+# Read the endpoints to spread prompts over, separated by ";". Each is a URL, optionally followed by "|" and the comma separated models it serves, and by another "|" and the presets it serves; an endpoint without models or presets serves any. Without a list, every prompt goes to the one URL.
+def parse_backends(string, url):
+    if string.lower() in ("", "n"):
+        return [{'url': url, 'models': [], 'presets': []}]
+    parsed = []
+    for entry in string.split(";"):
+        fields = [field.strip() for field in entry.split("|")] + ["", ""]
+        if fields[0] == "":
+            continue
+        parsed.append({
+            'url': fields[0].rstrip("/"),
+            'models': [model.strip() for model in fields[1].split(",") if model.strip()],
+            'presets': [preset.strip() for preset in fields[2].split(",") if preset.strip()],
+        })
+    return parsed or [{'url': url, 'models': [], 'presets': []}]
+
+# The health of each endpoint, shared by every prompt: how many requests it is answering, how long it took to answer recently, and until when it is left alone after failing.
+def backend_state(url):
+    with backends_lock:
+        if url not in backends:
+            backends[url] = {'in_flight': 0, 'failures': 0, 'down_until': 0, 'latency': None, 'headers': None}
+        return backends[url]
+
+# Note how a request to an endpoint went. A failure takes the endpoint out of rotation for backend_retry_interval seconds, doubled on every failure in a row up to backend_max_retry_interval; a success puts it back.
+def record_backend_result(url, ok, latency=None):
+    state = backend_state(url)
+    with backends_lock:
+        if ok:
+            state['failures'] = 0
+            state['down_until'] = 0
+            if latency is not None:
+                state['latency'] = latency if state['latency'] is None else 0.7 * state['latency'] + 0.3 * latency
+        else:
+            state['failures'] += 1
+            state['down_until'] = time.monotonic() + min(backend_retry_interval * 2 ** (state['failures'] - 1), backend_max_retry_interval)
+
+def backend_serves(backend, settings):
+    if settings['model'] == "n":
+        return True
+    return ((not backend['models'] or settings['model'] in backend['models'])
+            and (not backend['presets'] or settings['preset'] in backend['presets']))
+
+# Order the endpoints able to serve the settings' model and preset from best to worst: healthy before failed, then the fewest requests in flight, then those already known to have the model loaded, then the fastest to answer lately. Failed endpoints are kept at the end, soonest back first, so there is always one to try.
+def rank_backends(settings):
+    candidates = [backend for backend in settings['backends'] if backend_serves(backend, settings)] or settings['backends']
+    now = time.monotonic()
+    def load(backend):
+        state = backend_state(backend['url'])
+        down = state['down_until'] > now
+        loaded = settings['model'] == "n" or model_state_is_current(settings, backend['url'])
+        return (down, state['down_until'] if down else 0, state['in_flight'], not loaded, state['latency'] or 0)
+    return sorted(candidates, key=load)
+
+# Every backend_check_interval seconds, ask each known endpoint for its model list in the background, so a failed endpoint comes back as soon as it answers and one that went away is skipped before a prompt is sent to it.
+def check_backends():
+    while True:
+        time.sleep(backend_check_interval)
+        for url in list(backends):
+            try:
+                response = get_session('api').get(url + "/models", headers=backends[url]['headers'], timeout=(connect_timeout, 5), verify=True)
+                record_backend_result(url, response.status_code < 500)
+            except Exception:
+                record_backend_result(url, False)
+
+def start_backend_checks(settings):
+    global backend_checker
+    if len(settings['backends']) < 2:
+        return
+    with backends_lock:
+        if backend_checker is None:
+            backend_checker = threading.Thread(target=check_backends, daemon=True)
+            backend_checker.start()
+
+# This function builds the endpoint and request body for a prompt. In "completion" mode the prompt is sent as is, in "chat" mode it follows the chat history that fits the context window, and in "instruct" mode it follows the system prompt.
+def build_request(chat_history, prompt, settings, mode, stream):
     messages = []
-    if settings['model'] != "n":
-        enforce_model(settings)
     if mode == "completion":
         data = {
-            'stream': True,
-            'max_tokens': 4096,
+            'stream': stream,
+            'max_tokens': settings['response_tokens'],
             'prompt': prompt,
         }
-        response = requests.post(settings['url'] + "/completions", headers=settings['headers'], json=data, timeout=3600, verify=True, stream=True)
-        client = sseclient.SSEClient(response)
-        assistant_message = ""
-        for event in client.events():
-            payload = json.loads(event.data)
-            chunk = payload['choices'][0]['text']
-            assistant_message += chunk
-            print(chunk, end='')
+        return "/completions", data
     if mode == "chat":
-        for question, answer in chat_history:
+        for question, answer, tokens in select_history(chat_history, prompt, settings):
             messages.append({"role": "user", "content": question})
             messages.append({"role": "assistant", "content": answer})
         messages.append({"role": "user", "content": prompt})
         data = {
-            'stream': True,
-            'max_tokens': 4096,
+            'stream': stream,
+            'max_tokens': settings['response_tokens'],
             'messages': messages,
-            'mode': 'chat-instruct',
             'instruction_template': settings['instruct_template'],
+            'mode': 'chat-instruct',
             'character': settings['character'],
         }
-        response = requests.post(settings['url'] + "/chat/completions", headers=settings['headers'], json=data, timeout=3600, verify=True, stream=True)
-        client = sseclient.SSEClient(response)
-        assistant_message = ""
-        for event in client.events():
-            payload = json.loads(event.data)
-            chunk = payload['choices'][0]['message']['content']
-            assistant_message += chunk
-            print(chunk, end='')
+        return "/chat/completions", data
     if mode == "instruct":
         messages.append({"role": "system", "content": settings['system']})
         messages.append({"role": "user", "content": prompt})
         data = {
-            'stream': True,
+            'stream': stream,
             'mode': 'instruct',
             'instruction_template': settings['instruct_template'],
-            'max_tokens': 4096,
+            'max_tokens': settings['response_tokens'],
             'messages': messages,
         }
-        response = requests.post(settings['url'] + "/chat/completions", headers=settings['headers'], json=data, timeout=3600, verify=True, stream=True)
-        client = sseclient.SSEClient(response)
-        assistant_message = ""
-        for event in client.events():
-            payload = json.loads(event.data)
-            chunk = payload['choices'][0]['message']['content']
-            assistant_message += chunk
-            print(chunk, end='')
-    return(assistant_message)
+        return "/chat/completions", data
+
+# Pull the generated text out of a completion choice, whichever shape it comes in: text for completions, delta for streamed chat chunks, message for whole chat answers.
+def choice_text(choice):
+    if choice.get('text') is not None:
+        return choice['text']
+    for key in ('delta', 'message'):
+        if choice.get(key) and choice[key].get('content') is not None:
+            return choice[key]['content']
+    return ""
+
+# Remember how long the last answer took, how long until its first token and how fast it was generated, in response_stats unless other stats are given.
+def record_response_stats(started, first_token, tokens, stats=None):
+    stats = response_stats if stats is None else stats
+    finished = time.perf_counter()
+    stats['ttft'] = (first_token or finished) - started
+    stats['total'] = finished - started
+    stats['tokens'] = tokens
+    generating = finished - (first_token or started)
+    stats['tokens_per_second'] = tokens / generating if generating > 0 else 0
+
+# Split a server-sent event stream into the data of each event as bytes arrive, without waiting for a fixed-size read to fill up.
+def read_sse_events(chunks):
+    buffer = b""
+    data = []
+    for chunk in chunks:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line == b"":
+                if len(data) > 0:
+                    yield b"\n".join(data).decode('utf-8')
+                    data = []
+            elif line.startswith(b"data:"):
+                data.append(line[6:] if line.startswith(b"data: ") else line[5:])
+    if buffer.startswith(b"data:"):
+        data.append(buffer[6:] if buffer.startswith(b"data: ") else buffer[5:])
+    if len(data) > 0:
+        yield b"\n".join(data).decode('utf-8')
+
+# This function prints a streamed answer as it arrives and returns it whole. Chunks are kept in a list and joined once at the end, and the terminal is flushed every stream_flush_interval seconds rather than on every chunk or only when its buffer fills up. With the printer on, each line is sent to it as soon as it is complete. With a sink, each line is handed to it instead of the answer being written to the terminal. The timing of the answer goes in stats, or response_stats if none are given.
+def stream_response(response, chunks, started, printer=False, sink=None, stats=None):
+    parts = []
+    line = ""
+    first_token = None
+    tokens = 0
+    usage_tokens = None
+    last_flush = started
+    for data in read_sse_events(chunks):
+        if data == "[DONE]":
+            break
+        payload = json.loads(data)
+        if payload.get('usage'):
+            usage_tokens = payload['usage'].get('completion_tokens')
+        if not payload.get('choices'):
+            continue
+        chunk = choice_text(payload['choices'][0])
+        if chunk == "":
+            continue
+        now = time.perf_counter()
+        if first_token is None:
+            first_token = now
+        parts.append(chunk)
+        tokens += 1
+        if sink is None:
+            sys.stdout.write(chunk)
+        if printer or sink:
+            line += chunk
+            if "\n" in line:
+                complete, line = line.rsplit("\n", 1)
+                if printer:
+                    send_to_printer(complete + "\n")
+                if sink:
+                    sink(complete)
+        if sink is None and now - last_flush >= stream_flush_interval:
+            sys.stdout.flush()
+            last_flush = now
+    if sink is None:
+        sys.stdout.flush()
+    if printer:
+        send_to_printer(line + "\n")
+    if sink and line != "":
+        sink(line)
+    record_response_stats(started, first_token, usage_tokens or tokens, stats)
+    return "".join(parts)
+
+# The request engine runs on one asyncio event loop, started in a background thread the first time it is needed and shared by everything that sends requests. Blocking HTTP calls on the pooled sessions are handed to the loop's thread pool, so a model check, page downloads and search can overlap while the caller awaits them together.
+def get_event_loop():
+    global event_loop
+    with event_loop_lock:
+        if event_loop is None:
+            import asyncio
+            import concurrent.futures
+            event_loop = asyncio.new_event_loop()
+            event_loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=max(32, http_pool_size)))
+            threading.Thread(target=event_loop.run_forever, daemon=True).start()
+    return event_loop
+
+# Run a coroutine on the shared event loop from synchronous code and wait for its result.
+def run_async(coroutine):
+    import asyncio
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+# Run a blocking call in a thread of its own rather than the loop's thread pool, for requests that may be abandoned while still waiting on an endpoint: the interpreter waits for the pool's threads before exiting, but not for these.
+async def run_in_daemon_thread(function, *arguments, **keywords):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def finish(result, error):
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    def run():
+        try:
+            result = function(*arguments, **keywords)
+        except BaseException as e:
+            loop.call_soon_threadsafe(finish, None, e)
+        else:
+            loop.call_soon_threadsafe(finish, result, None)
+    threading.Thread(target=run, daemon=True).start()
+    return await future
+
+async def post_request_async(settings, endpoint, data, stream=False, url=None):
+    return await run_in_daemon_thread(get_session('api').post, (url or settings['url']) + endpoint, headers=settings['headers'], json=data, timeout=(connect_timeout, read_timeout), verify=True, stream=stream)
+
+# Wait for the first bytes of a streamed answer, and hand them back in front of the rest of the stream.
+def open_stream(response):
+    import itertools
+    chunks = response.iter_content(chunk_size=None)
+    first = next(chunks, b"")
+    return itertools.chain([first], chunks)
+
+def release_backend(url):
+    state = backend_state(url)
+    with backends_lock:
+        state['in_flight'] -= 1
+
+# Remember how long endpoints took to start answering, keeping the last max_latency_samples.
+def record_first_byte_latency(latency):
+    with backends_lock:
+        first_byte_latencies.append(latency)
+        del first_byte_latencies[:-max_latency_samples]
+
+# A request is hedged once it has waited longer than 95% of recent requests took to start answering, or hedge_delay seconds until enough of them have been seen.
+def hedge_threshold():
+    with backends_lock:
+        latencies = sorted(first_byte_latencies)
+    if len(latencies) < hedge_min_samples:
+        return hedge_delay
+    return latencies[int(0.95 * (len(latencies) - 1))]
+
+# This coroutine makes one attempt at a request on an endpoint, enforcing the model there first if necessary. It returns once the answer starts: when the whole answer is back, or when the first bytes of a stream have arrived. Nothing has been read from the answer yet if it fails, so it is safe to send again: connection errors, timeouts and retryable statuses are raised, and the endpoint is noted as failed. The endpoint counts the request as in flight until release_backend is called for a successful attempt.
+async def attempt_request_async(settings, url, endpoint, data, stream):
+    import asyncio
+    import requests
+    state = backend_state(url)
+    with backends_lock:
+        state['in_flight'] += 1
+        state['headers'] = settings['headers']
+    try:
+        if settings['model'] != "n":
+            await asyncio.to_thread(enforce_model, settings, False, url)
+        started = time.perf_counter()
+        response = await post_request_async(settings, endpoint, data, stream, url)
+        check_model_state(response, settings, url)
+        if response.status_code in retryable_statuses:
+            response.close()
+            response.raise_for_status()
+        chunks = await run_in_daemon_thread(open_stream, response) if stream else None
+    except requests.RequestException:
+        record_backend_result(url, False)
+        release_backend(url)
+        raise
+    except BaseException:
+        release_backend(url)
+        raise
+    latency = time.perf_counter() - started
+    record_backend_result(url, response.status_code < 500, latency)
+    record_first_byte_latency(latency)
+    return url, response, chunks, started, latency
+
+# Close the answer of an attempt that lost the race to a hedged one, whenever it finishes.
+def discard_attempt(task):
+    if task.cancelled() or task.exception() is not None:
+        return
+    url, response, chunks, started, latency = task.result()
+    response.close()
+    release_backend(url)
+
+# This coroutine sends a request to the best endpoint for the settings and hands the response to read, run in a thread along with the stream of its body and the time the request was sent. An attempt that can't connect, times out or gets a retryable status before its answer starts is retried up to request_retries times on the best endpoint at that point, which is another one if there is any left that hasn't failed, or after a jittered exponential backoff if not. With hedging, an attempt that hasn't started answering within hedge_threshold seconds is duplicated to the next endpoint and the first to answer is read. Once read starts, the answer is committed to that endpoint. The number of attempts, whether the request was hedged and how long its answer took to start go in stats. Errors from the last attempt are raised to the caller.
+async def send_request_async(settings, endpoint, data, read, stream=False, stats=None):
+    import asyncio
+    import random
+    import requests
+    stats = response_stats if stats is None else stats
+    stats['attempts'] = 0
+    stats['hedged'] = False
+    start_backend_checks(settings)
+    backoffs = 0
+    error = None
+    for attempt in range(request_retries + 1):
+        candidates = rank_backends(settings)
+        if attempt > 0 and backend_state(candidates[0]['url'])['down_until'] > time.monotonic():
+            await asyncio.sleep(random.uniform(0, min(retry_backoff * 2 ** backoffs, max_retry_backoff)))
+            backoffs += 1
+        pending = {asyncio.ensure_future(attempt_request_async(settings, candidates[0]['url'], endpoint, data, stream))}
+        stats['attempts'] += 1
+        if hedge_requests and len(candidates) > 1 and backend_state(candidates[1]['url'])['down_until'] <= time.monotonic():
+            done, pending = await asyncio.wait(pending, timeout=hedge_threshold())
+            pending = pending | done
+            if not done:
+                pending.add(asyncio.ensure_future(attempt_request_async(settings, candidates[1]['url'], endpoint, data, stream)))
+                stats['attempts'] += 1
+                stats['hedged'] = True
+        winner = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and winner is None:
+                    winner = task
+                elif task.exception() is None:
+                    discard_attempt(task)
+                elif isinstance(task.exception(), requests.RequestException):
+                    error = task.exception()
+                else:
+                    raise task.exception()
+        for task in pending:
+            task.add_done_callback(discard_attempt)
+        if winner is None:
+            continue
+        url, response, chunks, started, latency = winner.result()
+        stats['first_byte'] = latency
+        try:
+            with response:
+                return await asyncio.to_thread(read, response, chunks, started)
+        finally:
+            release_backend(url)
+    raise error
+
+# Read a whole answer from a response that wasn't streamed.
+def read_response(response, chunks, started):
+    answer_json = response.json()
+    tokens = (answer_json.get('usage') or {}).get('completion_tokens') or 0
+    record_response_stats(started, None, tokens)
+    return choice_text(answer_json['choices'][0])
+
+# The response cache keys an answer on a hash of everything that shapes it: the model and preset, the API address and endpoint and the whole request body but for whether it is streamed. It is used when response_cache is "y", except in "chat" mode once there is history to follow, or always when it is "always". Without a model to enforce ("n") there is no telling which model answers, so nothing is cached.
+def response_cache_key(chat_history, settings, mode, endpoint, data):
+    import hashlib
+    if settings['response_cache'] == "n" or settings['model'] == "n" or (settings['response_cache'] != "always" and mode == "chat" and len(chat_history) > 0):
+        return None
+    request = dict(data, model=settings['model'], preset=settings['preset'], url=settings['url'], endpoint=endpoint)
+    del request['stream']
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Give back a cached answer as if the endpoint had sent it, through the same path as a live one, so a streamed answer is printed the same way.
+def replay_response(answer, stream, printer=False):
+    started = time.perf_counter()
+    if stream:
+        chunks = [b"data: " + json.dumps({'choices': [{'delta': {'content': answer}}]}).encode('utf-8') + b"\n\n", b"data: [DONE]\n\n"]
+        return stream_response(None, chunks, started, printer)
+    record_response_stats(started, None, 0)
+    return answer
+
+# Count the tokens of the prompt and messages of a request, for the metrics.
+def request_tokens(data):
+    if 'prompt' in data:
+        return count_tokens(data['prompt'])
+    return sum(count_tokens(message['content']) + message_token_overhead for message in data['messages'])
+
+def record_generation_metrics(stats):
+    add_metric('tokens_out', stats.get('tokens', 0))
+    for name in metrics_gauges:
+        if name in stats:
+            set_metric(name, stats[name])
+
+# This coroutine generates an AI response in "completion", "chat" or "instruct" mode, or reuses the cached answer to the same request. A streamed answer is printed as it arrives. Errors are raised to the caller.
+async def generate_response_async(chat_history, prompt, settings, mode, stream=False):
+    import asyncio
+    endpoint, data = build_request(chat_history, prompt, settings, mode, stream)
+    if current_metrics() is not None:
+        add_metric('tokens_in', request_tokens(data))
+    key = response_cache_key(chat_history, settings, mode, endpoint, data)
+    response_stats['cached'] = False
+    if key:
+        cached = await asyncio.to_thread(cache_lookup, 'response', key, cache_response_ttl, 'response_')
+        if cached:
+            response_stats['cached'] = True
+            return await asyncio.to_thread(replay_response, cached[0], stream, settings['printer'])
+    read = functools.partial(stream_response, printer=settings['printer']) if stream else read_response
+    with StageTimer('generation'):
+        answer = await send_request_async(settings, endpoint, data, read, stream)
+    record_generation_metrics(response_stats)
+    if key and answer:
+        await asyncio.to_thread(cache_store, 'response', key, answer)
+    return answer
+
+# This coroutine adds online context to a prompt and answers it. The model check runs alongside the page downloads and search, so a model change doesn't hold up fetching. It returns the prompt with its context and the answer.
+async def answer_prompt_async(chat_history, user_message, settings, interactive=False, search_terms=None):
+    import asyncio
+    model_task = None
+    if settings['model'] != "n":
+        model_task = asyncio.create_task(asyncio.to_thread(enforce_model, settings, False, rank_backends(settings)[0]['url']))
+    user_message = await asyncio.to_thread(add_online_context, user_message, settings, interactive, search_terms)
+    if model_task:
+        await model_task
+    assistant_message = await generate_response_async(chat_history, user_message, settings, settings['mode'], settings['streaming'])
+    return user_message, assistant_message
+
+# This function generates an AI response based on the chat history and new question provided, waiting on the asynchronous engine. If there is an error during the process, it prints an error message.
+def generate_ai_response(chat_history, prompt, settings, mode):
+    try:
+        return run_async(generate_response_async(chat_history, prompt, settings, mode))
+    except Exception as e:
+        print(f"Error generating response: {str(e)}")
+
+def generate_streaming_response(chat_history, prompt, settings, mode):
+    return run_async(generate_response_async(chat_history, prompt, settings, mode, True))
+
+# This function answers a prompt with its online context, waiting on the asynchronous engine. Like generate_ai_response, errors are printed and give no answer unless streaming.
+def answer_prompt(chat_history, user_message, settings, interactive=False, search_terms=None):
+    if settings['streaming']:
+        return run_async(answer_prompt_async(chat_history, user_message, settings, interactive, search_terms))
+    try:
+        return run_async(answer_prompt_async(chat_history, user_message, settings, interactive, search_terms))
+    except Exception as e:
+        print(f"Error generating response: {str(e)}")
+        return user_message, None
+
+# What is known of each endpoint is kept in capabilities_file for capabilities_ttl seconds: whether it has the text-generation-webui internal endpoints, the model it had loaded and the models it offers. Read them all, or nothing if the file is missing or damaged.
+def read_capabilities():
+    try:
+        with open(capabilities_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def store_capabilities(url, capabilities):
+    with capabilities_lock:
+        endpoints = read_capabilities()
+        endpoints[url] = capabilities
+        try:
+            os.makedirs(os.path.dirname(capabilities_file), exist_ok=True)
+            temp_file = capabilities_file + ".tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(endpoints, f)
+            os.replace(temp_file, capabilities_file)
+        except OSError:
+            pass
+
+# Ask an endpoint for its loaded model and its list of models, and remember the answer. An endpoint that answers the model info request with 404 or 405 doesn't have the internal endpoints. One that can't be reached, refuses the request, as with a mistyped API key, or answers without a model name is left unknown, and None is returned.
+def probe_capabilities(url, headers):
+    capabilities = {'checked': time.time(), 'internal': False, 'model_name': None, 'model_names': []}
+    try:
+        response = get_session('api').get(url + "/internal/model/info", headers=headers, timeout=(connect_timeout, 2), verify=True)
+    except Exception:
+        return None
+    if response.status_code not in (404, 405):
+        if not response.ok:
+            return None
+        try:
+            capabilities['model_name'] = response.json()["model_name"]
+        except (ValueError, KeyError, TypeError):
+            return None
+        capabilities['internal'] = True
+        try:
+            response = get_session('api').get(url + "/internal/model/list", headers=headers, timeout=(connect_timeout, 5), verify=True)
+            capabilities['model_names'] = response.json()["model_names"]
+        except Exception:
+            pass
+    store_capabilities(url, capabilities)
+    return capabilities
+
+# Return what is known of an endpoint for setup without waiting on it: when it was checked within capabilities_ttl, the remembered values are returned at once and, if it has the internal endpoints, checked again in the background for next time. Endpoints known not to have them aren't asked at all. Otherwise the endpoint is asked now.
+def endpoint_capabilities(url, headers):
+    cached = read_capabilities().get(url)
+    if cached is None or time.time() - cached.get('checked', 0) >= capabilities_ttl:
+        return probe_capabilities(url, headers)
+    if cached['internal']:
+        threading.Thread(target=probe_capabilities, args=(url, headers), daemon=True).start()
+    return cached
 
 # This function initializes settings for an application by prompting the user for input and using default values if specified. It returns a dictionary containing the settings. 
 def initialize_settings(change_options, default):
@@ -287,7 +1041,11 @@ def initialize_settings(change_options, default):
     settings['searx_headers'] = ""
     settings['max_urls'] = 1
     settings['printer'] = False
+    settings['preload'] = False
     settings['history'] = ""
+    settings['cache'] = str(default['cache'])
+    settings['response_cache'] = str(default['response_cache']).lower()
+    settings['response_tokens'] = int(default['response_tokens'])
     if change_options == "n":
         settings['url'] = str(default['url'])
         settings['api_key'] = str(default['api_key'])
@@ -296,6 +1054,8 @@ def initialize_settings(change_options, default):
             settings['model'] = str(default['model'])
         else:
             settings['model'] = "n"
+        if str(default['preload']) == "y":
+            settings['preload'] = True
         settings['preset'] = str(default['preset'])
         settings['mode'] = str(default['mode'])
         settings['instruct_template'] = str(default['instruct_template'])
@@ -312,6 +1072,7 @@ def initialize_settings(change_options, default):
             settings['searx_headers'] = generate_headers(settings['searx_api_key'])
         settings['max_urls'] = default['max_urls']
         settings['max_tokens'] = default['max_tokens']
+        settings['context_tokens'] = int(default['context_tokens'])
         if str(default['streaming']) == "y":
             settings['streaming'] = True
         if os.path.exists(printer_target):
@@ -326,22 +1087,27 @@ def initialize_settings(change_options, default):
             settings['api_key'] = str(input("Enter the api key: ") or default['api_key'])
         settings['headers'] = generate_headers(settings['api_key'])
         reset_screen()
-        try:
-            response = requests.get(settings['url'] + "/internal/model/info", headers=settings['headers'], timeout=2, verify=True)
-            answer_json = response.json()
-            print("Currently loaded model: " + answer_json["model_name"])
-        except:
+        capabilities = endpoint_capabilities(settings['url'], settings['headers'])
+        if capabilities is None:
             print("Endpoint did not respond to model info request")
+        elif not capabilities['internal']:
+            print("Endpoint does not support loading models")
+            settings['model'] = "n"
+        else:
+            print("Currently loaded model: " + str(capabilities['model_name']))
         while settings['model'] != "n" and settings['model'] != "y":
             settings['model'] = str(input("Enter y if you want to run another model than currently loaded (empty for no): ") or "n")
         if settings['model'] == "y":
             try:
-                response = requests.get(settings['url'] + "/internal/model/list", headers=settings['headers'], timeout=5, verify=True)
+                # The background refresh has likely finished by now, use what it found
+                model_names = (read_capabilities().get(settings['url']) or dict()).get('model_names')
+                if not model_names:
+                    response = get_session('api').get(settings['url'] + "/internal/model/list", headers=settings['headers'], timeout=(connect_timeout, 5), verify=True)
+                    model_names = response.json()["model_names"]
                 print("Available models:")
-                answer_json = response.json()
                 i = 0 
                 model_table = {}
-                for name in answer_json["model_names"]:
+                for name in model_names:
                     model_table[i] = name
                     print(str(i) + ": " + name)
                     i = i + 1
@@ -358,6 +1124,8 @@ def initialize_settings(change_options, default):
                 settings['model'] = str(default['model'])
             reset_screen()
             settings['preset'] = str(input("Enter the preset to use (empty for default: " + str(default['preset']) + "): ") or default['preset'])
+            if str(default['preload']) == "y":
+                settings['preload'] = True
         reset_screen()
         while settings['mode'] != "chat" and settings['mode'] != "instruct":
             if default['mode'] != "chat" and default['mode'] != "instruct":
@@ -388,6 +1156,7 @@ def initialize_settings(change_options, default):
         reset_screen()
         settings['max_urls'] = int(default['max_urls'])
         settings['max_tokens'] = int(default['max_tokens'])
+        settings['context_tokens'] = int(default['context_tokens'])
         reset_screen()
         answer = ""
         while answer != "y" and answer != "n":
@@ -405,11 +1174,108 @@ def initialize_settings(change_options, default):
                 settings['printer'] = True
             else:
                 settings['printer'] = False
+    settings['backends'] = parse_backends(str(default['backends']), settings['url'])
     if len(sys.argv)==1:
-        os.system('cls||clear')
+        clear_screen()
         output_result(banner, settings['printer'])
     return settings
 
+# The content cache keeps the text extracted from web pages and the Searx results for a query in a SQLite file, so a repeated search doesn't go to the network or parse the pages again. Entries expire after their TTL, the least recently used ones are evicted once the file grows past cache_max_bytes, and expired pages are revalidated with their ETag or Last-Modified date.
+def open_cache(file):
+    global cache_connection, cache_file
+    if file == "n" or file == "" or (cache_connection is not None and file == cache_file):
+        return
+    import sqlite3
+    cache_file = file
+    try:
+        with cache_lock:
+            cache_connection = sqlite3.connect(file, check_same_thread=False)
+            cache_connection.execute("CREATE TABLE IF NOT EXISTS entries (kind TEXT, key TEXT, value TEXT, etag TEXT, last_modified TEXT, stored REAL, accessed REAL, size INTEGER, PRIMARY KEY (kind, key))")
+            cache_connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            cache_connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            cache_connection.commit()
+    except sqlite3.Error as e:
+        cache_connection = None
+        print(f"Error opening cache: {str(e)}")
+
+def count_cache_event(name):
+    cache_stats[name] = cache_stats.get(name, 0) + 1
+    cache_connection.execute("INSERT INTO stats VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,))
+
+# This function returns the cached (value, etag, last_modified, fresh) for a key, or None when the cache is off or the key is missing. Expired entries are still returned when they can be revalidated. Lookups are counted in the statistics under stats_prefix, so answers can be told apart from pages and searches.
+def cache_lookup(kind, key, ttl, stats_prefix=""):
+    if cache_connection is None:
+        return None
+    with cache_lock:
+        row = cache_connection.execute("SELECT value, etag, last_modified, stored FROM entries WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        if row is None:
+            count_cache_event(stats_prefix + 'misses')
+            cache_connection.commit()
+            return None
+        value, etag, last_modified, stored = row
+        fresh = time.time() - stored < ttl
+        if not fresh and not etag and not last_modified:
+            cache_connection.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+            count_cache_event(stats_prefix + 'misses')
+            cache_connection.commit()
+            return None
+        count_cache_event(stats_prefix + ('hits' if fresh else 'stale'))
+        cache_connection.execute("UPDATE entries SET accessed = ? WHERE kind = ? AND key = ?", (time.time(), kind, key))
+        cache_connection.commit()
+        return value, etag, last_modified, fresh
+
+def cache_store(kind, key, value, etag=None, last_modified=None):
+    if cache_connection is None:
+        return
+    now = time.time()
+    size = len(key) + len(value.encode('utf-8'))
+    with cache_lock:
+        cache_connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (kind, key, value, etag, last_modified, now, now, size))
+        total = cache_connection.execute("SELECT SUM(size) FROM entries").fetchone()[0] or 0
+        if total > cache_max_bytes:
+            evicted = 0
+            for evict_kind, evict_key, evict_size in cache_connection.execute("SELECT kind, key, size FROM entries ORDER BY accessed").fetchall():
+                if total <= cache_max_bytes:
+                    break
+                cache_connection.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (evict_kind, evict_key))
+                total -= evict_size
+                evicted += 1
+            cache_stats['evictions'] = cache_stats.get('evictions', 0) + evicted
+            cache_connection.execute("INSERT INTO stats VALUES ('evictions', ?) ON CONFLICT (name) DO UPDATE SET value = value + ?", (evicted, evicted))
+        cache_connection.commit()
+
+# Mark an expired entry fresh again after the server confirmed with a 304 that it hasn't changed.
+def cache_revalidated(kind, key):
+    with cache_lock:
+        cache_connection.execute("UPDATE entries SET stored = ? WHERE kind = ? AND key = ?", (time.time(), kind, key))
+        count_cache_event('revalidated')
+        cache_connection.commit()
+
+def read_cache_stats():
+    if cache_connection is None:
+        return dict()
+    with cache_lock:
+        stats = dict(cache_connection.execute("SELECT name, value FROM stats").fetchall())
+        stats['entries'], stats['bytes'] = cache_connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+    return stats
+
+def print_cache_stats():
+    stats = read_cache_stats()
+    if len(stats) == 0:
+        print("The cache is not enabled")
+        return
+    lookups = stats.get('hits', 0) + stats.get('stale', 0) + stats.get('misses', 0)
+    hit_rate = 100 * (stats.get('hits', 0) + stats.get('revalidated', 0)) / lookups if lookups else 0
+    print("Cache entries: " + str(stats['entries']) + " (" + str(stats['bytes']) + " bytes)")
+    print("Hits: " + str(stats.get('hits', 0)) + ", expired: " + str(stats.get('stale', 0)) + ", revalidated: " + str(stats.get('revalidated', 0)) + ", misses: " + str(stats.get('misses', 0)) + ", evictions: " + str(stats.get('evictions', 0)))
+    print("Hit rate: " + str(round(hit_rate, 1)) + "%")
+    response_lookups = stats.get('response_hits', 0) + stats.get('response_misses', 0)
+    if response_lookups:
+        print("Answers reused: " + str(stats.get('response_hits', 0)) + ", generated: " + str(stats.get('response_misses', 0)) + ", hit rate: " + str(round(100 * stats.get('response_hits', 0) / response_lookups, 1)) + "%")
+
+def normalize_query(search_term):
+    return " ".join(search_term.lower().split())
+
 def extract_url(prompt):
     url = ""
     # Regular expression to match URLs
@@ -430,71 +1296,518 @@ def trim_to_x_words(prompt, limit):
     rs = reversed(rev_rs)
     return " ".join(rs)
 
-def expand_url(url):
+# This parser is fed a page in chunks as it downloads and collects the text of its <p> elements, plus the page topic and description from its <meta> tags, in a single pass without building a document tree.
+class PageTextExtractor(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = []
+        self.metas = []
+        self.length = 0
+        self.depth = 0
+        self.current = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "p":
+            self.depth += 1
+        if tag == "meta":
+            attributes = dict(attrs)
+            if attributes.get("name") in ("page-topic", "description") and attributes.get("content"):
+                self.metas.append((attributes["name"], attributes["content"]))
+
+    def handle_endtag(self, tag):
+        if tag == "p" and self.depth > 0:
+            self.depth -= 1
+            if self.depth == 0:
+                paragraph = "".join(self.current)
+                self.paragraphs.append(paragraph)
+                self.length += len(paragraph) + 1
+                self.current = []
+
+    def handle_data(self, data):
+        if self.depth > 0:
+            self.current.append(data)
+
+# Yield the body of a streamed response as its bytes arrive, at most size at a time, instead of waiting for every read to fill up, so a download trickling in can still be stopped on time.
+def iter_arriving(response, size=65536):
+    if not hasattr(response.raw, 'read1'):
+        yield from response.iter_content(chunk_size=size)
+        return
+    while True:
+        chunk = response.raw.read1(size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+# This function downloads a page in chunks, giving up on anything that isn't text and never reading more than max_page_bytes, and extracts its paragraphs as they arrive. Once enough text to fill max_tokens has been collected, or the deadline (a time.monotonic() value) has passed, the rest of the page isn't downloaded. A page cut short this way isn't cached, so a later prompt with more room gets all of it.
+@metered('fetch')
+def expand_url(url, max_tokens=None, deadline=None):
+    import itertools
+    import urllib.parse
     text = f"The web page at {url} doesn't have any useable content. Sorry."
+    cached = cache_lookup('page', url, cache_page_ttl)
+    if cached and cached[3]:
+        print("Fetched " + str(url) + " from cache")
+        return cached[0]
+    headers = dict()
+    if cached and cached[1]:
+        headers['If-None-Match'] = cached[1]
+    if cached and cached[2]:
+        headers['If-Modified-Since'] = cached[2]
+    extractor = PageTextExtractor()
     try:
-        response = requests.get(url, timeout=5)
-        print("Fetched " + str(url))
+        with get_session('web').get(url, headers=headers, timeout=(connect_timeout, 5), stream=True) as response:
+            if cached and response.status_code == 304:
+                print("Fetched " + str(url))
+                cache_revalidated('page', url)
+                return cached[0]
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            chunks = iter_arriving(response)
+            is_pdf = content_type == "application/pdf" or urllib.parse.urlparse(url).path.lower().endswith(".pdf")
+            if not is_pdf and content_type != "" and not content_type.startswith("text/") and content_type not in text_content_types:
+                # PDFs are often served as application/octet-stream, so look at how the file starts before giving up on it
+                first = next(chunks, b"")
+                chunks = itertools.chain([first], chunks)
+                is_pdf = first.lstrip().startswith(b"%PDF-")
+            if is_pdf:
+                text, complete = expand_pdf(response, url, max_tokens, deadline, chunks)
+                print("Fetched " + str(url))
+                if response.ok and complete:
+                    cache_store('page', url, text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                return text
+            if content_type != "" and not content_type.startswith("text/") and content_type not in text_content_types:
+                print("Skipped " + str(url) + " (" + content_type + ")")
+                return f"The page {url} is not a web page but a {content_type} file."
+            decoder = codecs.getincrementaldecoder(response.encoding if 'charset' in response.headers.get('Content-Type', '') else 'utf-8')(errors='replace')
+            received = 0
+            complete = True
+            for chunk in chunks:
+                chunk = chunk[:max_page_bytes - received]
+                received += len(chunk)
+                with StageTimer('parse'):
+                    extractor.feed(decoder.decode(chunk))
+                if received >= max_page_bytes:
+                    break
+                if max_tokens is not None and extractor.length >= max_tokens * max_chars_per_token:
+                    complete = False
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    complete = False
+                    break
+            extractor.feed(decoder.decode(b"", final=True))
+            add_metric('bytes_fetched', received)
+            print("Fetched " + str(url))
     except:
         return f"The page {url} could not be loaded"
-    soup = BeautifulSoup(response.content, "html.parser")
-    paragraphs = soup.find_all("p")
-    if len(paragraphs) > 0:
-        text = "\n".join(p.get_text() for p in paragraphs)
+    if len(extractor.paragraphs) > 0:
+        text = "\n".join(extractor.paragraphs)
         text = f"\n\n---\n\nContent of {url} : \n{trim_to_x_words(text, max_text_length)}[...]"
     else:
         text = f"The web page at {url} doesn't seem to have any readable content."
-        metas = soup.find_all("meta")
-        for m in metas:
-            if "content" in m.attrs:
-                try:
-                    if (
-                        "name" in m
-                        and m["name"] == "page-topic"
-                        or m["name"] == "description"
-                    ):
-                        if "content" in m and m["content"] != None:
-                            text += f"It's {m['name']} is '{m['content']}'"
-                except:
-                    pass
+        for name, content in extractor.metas:
+            text += f"It's {name} is '{content}'"
+    if response.ok and complete:
+        cache_store('page', url, text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
     return text
 
-def write_history(text, file):
-    f=open(file,'w+')
-    json.dump(text, f)
-
-def read_history(file):
-    f=open(file,'r')
-    history = json.load(f)
-    return history
-
-def trim_to_max_tokens(string, maximum, reverse=False):
-    def count_token(string):
-        token_counter = tiktoken.get_encoding("cl100k_base")
-        return len(token_counter.encode(string))
-    if count_token(string) > maximum:
-        print("Context too long, truncating context")
-        print("Original context: " + str(count_token(string)))
-        while count_token(string) > maximum:
-            step = 100
-            if (count_token(string) - maximum) > 10000:
-                step = 10000
-            if (count_token(string) - maximum) > 100000:
-                step = 10000
-            if (count_token(string) - maximum) > 300000:
-                step = 100000
-            new_length = len(string) - step
-            if reverse:
-                string = string[new_length:]
-            else:
-                string = string[:new_length]
-        print("New context: " + str(count_token(string)))
+# This function spools a PDF download to a temporary file, kept in memory while it is small, reading no more than max_pdf_bytes and nothing after the deadline. Pages are then extracted one at a time, stopping once enough text to fill max_tokens has been collected. It returns the text and whether all of the document was read. The body is read from chunks when some of it has been read already.
+def expand_pdf(response, url, max_tokens=None, deadline=None, chunks=None):
+    import PyPDF2
+    with tempfile.SpooledTemporaryFile(max_size=pdf_spool_bytes) as pdf_file:
+        received = 0
+        complete = True
+        for chunk in chunks or iter_arriving(response):
+            chunk = chunk[:max_pdf_bytes - received]
+            received += len(chunk)
+            pdf_file.write(chunk)
+            if received >= max_pdf_bytes:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                complete = False
+                break
+        add_metric('bytes_fetched', received)
+        pdf_file.seek(0)
+        try:
+            reader = PyPDF2.PdfReader(pdf_file)
+            pages = []
+            length = 0
+            for page in reader.pages:
+                with StageTimer('parse'):
+                    page_text = page.extract_text() or ""
+                pages.append(page_text)
+                length += len(page_text)
+                if max_tokens is not None and length >= max_tokens * max_chars_per_token:
+                    complete = complete and len(pages) == len(reader.pages)
+                    break
+        except Exception as e:
+            if received >= max_pdf_bytes:
+                return f"The PDF document at {url} is too large to be read.", complete
+            return f"The PDF document at {url} could not be read: {str(e)}", False
+    text = "\n\n\n".join(page for page in pages if page.strip())
+    if text == "":
+        return f"The PDF document at {url} doesn't seem to have any readable text.", complete
+    return f"\n\n---\n\nContent of {url} : \n{trim_to_x_words(text, max_text_length)}[...]", complete
+
+# This function runs each (source, fetch) job on at most fetch_workers daemon threads and returns the fetched texts in the order the jobs were given, so search ranking is kept. Each fetch is given the deadline, fetch_deadline seconds after the start, and stops downloading once it has passed. Jobs not finished by then are abandoned and replaced by a note, so one slow page can't hold up the prompt, nor the exit of the process.
+def fetch_concurrently(jobs):
+    import queue
+    results = [f"The page {source} could not be loaded in time" for source, fetch in jobs]
+    if len(jobs) == 0:
+        return results
+    deadline = time.monotonic() + fetch_deadline
+    waiting = queue.Queue()
+    for i, job in enumerate(jobs):
+        waiting.put((i, job))
+    finished = queue.Queue()
+    def work():
+        while time.monotonic() < deadline:
+            try:
+                i, (source, fetch) = waiting.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                finished.put((i, fetch(source, deadline)))
+            except Exception:
+                finished.put((i, f"The page {source} could not be loaded"))
+    for _ in range(min(fetch_workers, len(jobs))):
+        threading.Thread(target=work, daemon=True).start()
+    done = set()
+    while len(done) < len(jobs):
+        try:
+            i, text = finished.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            break
+        results[i] = text
+        done.add(i)
+    for i, (source, fetch) in enumerate(jobs):
+        if i not in done:
+            print("Gave up waiting for " + str(source))
+    return results
+
+# The history file is a journal holding one JSON [question, answer] record per line. Each turn is appended and fsynced, so a crash can at worst leave a torn last line, which is cut off the next time the journal is loaded.
+def append_history(entry, file):
+    with history_lock:
+        with open(file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(list(entry)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+# Rewrite the journal to a temporary file and swap it in atomically, so the original stays intact if anything goes wrong halfway.
+def rewrite_history(entries, file):
+    temp_file = file + ".tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(list(entry)) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, file)
+
+# Replace the last record of the journal, as when (continue) adds to the last answer, by cutting the file back to the start of its last line and appending the new record there.
+def replace_last_history(entry, file):
+    with history_lock:
+        with open(file, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            # Leave out the newline ending the last record
+            position = max(f.tell() - 1, 0)
+            start = 0
+            while position > 0:
+                step = min(history_block_size, position)
+                position -= step
+                f.seek(position)
+                newline = f.read(step).rfind(b"\n")
+                if newline != -1:
+                    start = position + newline + 1
+                    break
+            f.truncate(start)
+            f.seek(start)
+            f.write((json.dumps(list(entry)) + "\n").encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+# History files written by older versions hold a single JSON list, convert them to the journal format in place.
+def migrate_history(file):
+    with open(file, 'r', encoding='utf-8') as f:
+        # A legacy file is one list of [question, answer] lists, or an empty one, while every journal record starts with its question
+        if not re.match(r"\s*\[\s*[\[\]]", f.read(64)):
+            return
+        f.seek(0)
+        try:
+            entries = json.load(f)
+        except ValueError:
+            return
+    if not isinstance(entries, list) or any(not isinstance(entry, list) for entry in entries):
+        return
+    with history_lock:
+        rewrite_history(entries, file)
+
+# Cut off a record left half written by a crash, so the next append starts on a clean line.
+def repair_history(file):
+    with history_lock:
+        with open(file, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            position = size
+            while position > 0:
+                step = min(history_block_size, position)
+                position -= step
+                f.seek(position)
+                block = f.read(step)
+                newline = block.rfind(b"\n")
+                if newline != -1:
+                    f.truncate(position + newline + 1)
+                    return
+            f.truncate(0)
+
+# Yield the lines of a file from the last one to the first, reading fixed-size blocks backwards from the end.
+def read_lines_reversed(f):
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    remainder = b""
+    while position > 0:
+        step = min(history_block_size, position)
+        position -= step
+        f.seek(position)
+        lines = (f.read(step) + remainder).split(b"\n")
+        remainder = lines.pop(0)
+        for line in reversed(lines):
+            yield line
+    yield remainder
+
+# Drop unreadable records from the journal and add token counts to records missing them. Runs in a background thread, appends made meanwhile wait on the lock.
+def compact_history(file):
+    try:
+        with history_lock:
+            entries = []
+            with open(file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(make_history_entry(*json.loads(line)))
+                    except (ValueError, TypeError):
+                        pass
+            rewrite_history(entries, file)
+    except Exception as e:
+        print(f"Error compacting history: {str(e)}")
+
+# This function loads the most recent entries of the history journal, stopping once the given number of entries or the token budget is reached, without reading the rest of the file. Legacy JSON history files are migrated first.
+def read_history(file, last=None, budget=None):
+    migrate_history(file)
+    repair_history(file)
+    entries = []
+    damaged = False
+    used = 0
+    with open(file, 'rb') as f:
+        for line in read_lines_reversed(f):
+            if last is not None and len(entries) >= last:
+                break
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                entry = make_history_entry(*record)
+            except (ValueError, TypeError):
+                damaged = True
+                continue
+            if len(record) < 3:
+                # Records saved before token counts were kept are counted once here and rewritten with their count
+                damaged = True
+            used += entry[2]
+            if budget is not None and used > budget:
+                break
+            entries.append(entry)
+    if damaged:
+        threading.Thread(target=compact_history, args=(file,), daemon=True).start()
+    entries.reverse()
+    return entries
+
+def history_stamp(file):
+    status = os.stat(file)
+    return (status.st_size, status.st_mtime_ns)
+
+# Load a history journal, reusing the entries already loaded from it when the file hasn't changed since, as it won't between prompts answered by the daemon.
+def load_history(settings):
+    file = settings['history']
+    stamp = history_stamp(file)
+    if file in loaded_histories and loaded_histories[file][0] == stamp:
+        return loaded_histories[file][1]
+    entries = read_history(file, history_tail, settings['context_tokens'])
+    loaded_histories[file] = (history_stamp(file), entries)
+    return entries
+
+# Note that the loaded entries are current after appending the last one to the journal.
+def remember_history(file, entries):
+    loaded_histories[file] = (history_stamp(file), entries)
+
+# Load the tokenizer once and reuse it for every count and truncation afterwards.
+def get_token_encoder():
+    global token_encoder
+    if token_encoder is None:
+        import tiktoken
+        token_encoder = tiktoken.get_encoding(token_encoding)
+    return token_encoder
+
+def count_tokens(string):
+    return len(get_token_encoder().encode(string, disallowed_special=()))
+
+# This function encodes the string a single time and cuts it at an exact token boundary, keeping the head of the string, or the tail if reverse is set. Counts before and after are taken from the token list, so nothing is encoded twice. The cut is reported unless quiet is set.
+@metered('trim')
+def trim_to_max_tokens(string, maximum, reverse=False, quiet=False):
+    encoder = get_token_encoder()
+    tokens = encoder.encode(string, disallowed_special=())
+    original_count = len(tokens)
+    if original_count > maximum:
+        if not quiet:
+            print("Context too long, truncating context")
+            print("Original context: " + str(original_count))
+        if reverse:
+            tokens = tokens[original_count - maximum:]
+        else:
+            tokens = tokens[:maximum]
+        # A cut can land inside a multi-byte character, drop the partial character on the cut side
+        if reverse:
+            string = encoder.decode(tokens).lstrip("\ufffd")
+        else:
+            string = encoder.decode(tokens).rstrip("\ufffd")
+        if not quiet:
+            print("New context: " + str(len(tokens)))
     return string
 
 
-def search_routine(string, settings, direct=False):
-    def search_string(search_term, settings):
+# The tail of the last exchange that (continue) picks up from is kept as tokens: its question without the web content, then the answer, cut to the last continue_tokens. Each continue only encodes the newly generated text and adds it to the tail, so the prompt stays the same size however many times it is continued.
+def start_continuation(question, answer):
+    return get_token_encoder().encode(strip_online_context(question) + "\n" + answer, disallowed_special=())[-continue_tokens:]
+
+def extend_continuation(tail, text):
+    return (tail + get_token_encoder().encode(text, disallowed_special=()))[-continue_tokens:]
+
+# A cut can land inside a multi-byte character, drop the partial character at the start
+def continuation_prompt(tail):
+    return get_token_encoder().decode(tail).lstrip("\ufffd")
+
+
+# A history entry is a (question, answer, tokens) tuple, the token count is computed once when the entry is created and stored with it.
+def make_history_entry(question, answer, tokens=None):
+    if tokens is None:
+        tokens = count_tokens(question) + count_tokens(answer) + 2 * message_token_overhead
+    return (question, answer, tokens)
+
+# This function works out how many tokens of the context window are left for history once the pinned system or character preamble, the new prompt and the response are accounted for.
+def history_budget(prompt, settings):
+    preamble = settings['system'] if settings['mode'] == "instruct" else settings['character']
+    reserved = count_tokens(preamble) + count_tokens(prompt) + 2 * message_token_overhead + settings['response_tokens']
+    return max(settings['context_tokens'] - reserved, 0)
+
+# Web context gets at most max_tokens, and no more than the context window leaves once the preamble, the question and the answer are set aside, so a prompt with its context fits the window even before any history.
+def context_budget(question, settings):
+    return min(settings['max_tokens'], history_budget(question, settings))
+
+# This function picks the newest history entries that fit the context window, walking back from the latest turn and summing the cached counts, so no entry is tokenized again.
+def select_history(chat_history, prompt, settings):
+    budget = history_budget(prompt, settings)
+    used = 0
+    start = len(chat_history)
+    while start > 0 and used + chat_history[start - 1][2] <= budget:
+        start -= 1
+        used += chat_history[start][2]
+    if start > 0:
+        print("Context window full, leaving out the " + str(start) + " oldest exchanges")
+    return chat_history[start:]
+
+# Split fetched context into passages of up to passage_chars characters, each tagged with the heading of the page, infobox or answer it came from, so passages can be ranked on their own and still be attributed.
+def split_passages(context):
+    passages = []
+    heading = ""
+    current = []
+    length = 0
+    def flush():
+        if len(current) > 0:
+            passages.append((heading, "\n".join(current)))
+        current.clear()
+    for line in context.split("\n"):
+        if line.strip() == "" or line.strip() == "---":
+            continue
+        if re.match(r"^(Contents? of .*|Information about .* in HTML format|Answer found online):\s*$", line):
+            flush()
+            length = 0
+            heading = line
+            continue
+        while len(line) > passage_chars:
+            cut = line.rfind(" ", 0, passage_chars)
+            if cut <= 0:
+                cut = passage_chars
+            flush()
+            current.append(line[:cut])
+            flush()
+            line = line[cut:].lstrip()
+        if length + len(line) > passage_chars:
+            flush()
+            length = 0
+        current.append(line)
+        length += len(line) + 1
+    flush()
+    return passages
+
+def passage_terms(text):
+    return re.findall(r"\w+", text.lower())
+
+# This function ranks the passages of fetched context against the question with BM25 and fills the token budget with the best ones first. Chosen passages are given back in their original order under the heading of their page, so the part of a page that answers the question is kept instead of whatever came first.
+@metered('rank')
+def select_passages(context, question, maximum):
+    passages = split_passages(context)
+    if len(passages) == 0:
+        return context
+    terms = [passage_terms(text) for heading, text in passages]
+    query = set(passage_terms(question))
+    document_frequency = dict()
+    for passage in terms:
+        for term in query.intersection(passage):
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    average_length = sum(len(passage) for passage in terms) / len(terms) or 1
+    scores = []
+    for i, passage in enumerate(terms):
+        frequencies = dict()
+        for term in passage:
+            if term in document_frequency:
+                frequencies[term] = frequencies.get(term, 0) + 1
+        score = 0
+        for term, frequency in frequencies.items():
+            idf = math.log((len(terms) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5) + 1)
+            score += idf * frequency * (bm25_k1 + 1) / (frequency + bm25_k1 * (1 - bm25_b + bm25_b * len(passage) / average_length))
+        scores.append((-score, i))
+    scores.sort()
+    chosen = []
+    used = 0
+    headings = set()
+    for score, i in scores:
+        heading = passages[i][0]
+        tokens = count_tokens(passages[i][1]) + 1
+        if heading not in headings:
+            # Passages of a page are adjacent, so its heading is written once whichever of them are chosen
+            tokens += count_tokens("\n\n---\n\n" + heading + "\n")
+        if used + tokens <= maximum:
+            chosen.append(i)
+            headings.add(heading)
+            used += tokens
+    if len(chosen) < len(passages):
+        print("Context too long, kept the " + str(len(chosen)) + " most relevant of " + str(len(passages)) + " passages")
+    chosen.sort()
+    text = ""
+    heading = ""
+    for i in chosen:
+        if passages[i][0] != heading:
+            heading = passages[i][0]
+            text = text + "\n\n---\n\n" + heading + "\n"
+        text = text + passages[i][1] + "\n"
+    return text
+
+def search_routine(string, settings, direct=False, question=None):
+    def search_string(search_term, settings, question):
+        @metered('parse')
         def html_table_to_text(html_string):
+            from bs4 import BeautifulSoup
             soup = BeautifulSoup(html_string, 'html.parser')
             tables = soup.find_all('table')
             rows = []
@@ -508,36 +1821,37 @@ def search_routine(string, settings, direct=False):
             return text
 
         print("Searching for " + search_term + "...")
-        r = requests.get(settings['searx_url'], params={'q': search_term,'format': 'json','pageno': '1'}, headers=settings['searx_headers'], timeout=30, verify=True)
+        search_key = settings['searx_url'] + " " + normalize_query(search_term)
+        cached = cache_lookup('search', search_key, cache_search_ttl)
+        if cached and cached[3]:
+            search_body = cached[0]
+        else:
+            with StageTimer('search'):
+                r = get_session('searx').get(settings['searx_url'], params={'q': search_term,'format': 'json','pageno': '1'}, headers=settings['searx_headers'], timeout=(connect_timeout, 30), verify=True)
+            add_metric('bytes_fetched', len(r.content))
+            search_body = r.text
         new_context = ""
         try:
-            searchdata = r.json()
+            searchdata = json.loads(search_body)
             resultsdata = searchdata['results']
             infodata = searchdata['infoboxes']
             answerdata = searchdata['answers']
+            if not (cached and cached[3]):
+                cache_store('search', search_key, search_body)
         except: 
             new_context = "Could not find the results asked for"
         try:
             if resultsdata[0]['url']:
-                i = 0
-                while i < settings['max_urls']:
-                    if resultsdata[i]['engine'] == "meilisearch":
-                        print("Found " + str(resultsdata[i]['title']) + " on local Meilisearch instance")
-                        new_context = new_context + "Contents of " + str(resultsdata[i]['title']) + ":\n" + str(resultsdata[i]['content']) + "\n"
+                jobs = []
+                for result in resultsdata[:settings['max_urls']]:
+                    if result['engine'] == "meilisearch":
+                        print("Found " + str(result['title']) + " on local Meilisearch instance")
+                        jobs.append((str(result['title']), lambda title, deadline, content=str(result['content']): "Contents of " + title + ":\n" + content))
                     else:
-                        print("Found " + str(resultsdata[i]['url']))
-                        if str(resultsdata[i]['url']).endswith('.pdf'):
-                            response = requests.get(resultsdata[i]['url'])
-                            with io.BytesIO(response.content) as pdf_file:
-                                read_pdf = PyPDF2.PdfFileReader(pdf_file)
-                                number_of_pages = read_pdf.getNumPages()
-                                p = 0
-                                while p < number_of_pages:
-                                    page = read_pdf.pages[p]
-                                    text = text + "\n\n\n" + page.extractText()
-                        else:
-                            new_context = new_context + expand_url(resultsdata[i]['url']) + "\n"
-                    i = i + 1
+                        print("Found " + str(result['url']))
+                        jobs.append((result['url'], lambda url, deadline: expand_url(url, settings['max_tokens'], deadline)))
+                for text in fetch_concurrently(jobs):
+                    new_context = new_context + text + "\n"
         except:
             pass
         try:
@@ -545,7 +1859,7 @@ def search_routine(string, settings, direct=False):
                 i = 0
                 while i < settings['max_urls']:
                     print("Found " + str(infodata[i]['infobox']))
-                    new_context = new_context + "Information in HTML format: " + trim_to_x_words(html_table_to_text(str(infodata[i]['content'])), max_text_length) + "\n"
+                    new_context = new_context + "Information about " + str(infodata[i]['infobox']) + " in HTML format:\n" + trim_to_x_words(html_table_to_text(str(infodata[i]['content'])), max_text_length) + "\n"
                     i = i + 1
         except:
             pass
@@ -554,15 +1868,15 @@ def search_routine(string, settings, direct=False):
                 i = 0
                 while i < settings['max_urls']:
                     print("Found " + str(answerdata[i]['answer']))
-                    new_context = new_context + "Answer found online: " + trim_to_x_words(str(answerdata[i]['content']), max_text_length) + "\n"
+                    new_context = new_context + "Answer found online:\n" + trim_to_x_words(str(answerdata[i]['content']), max_text_length) + "\n"
                     i = i + 1
         except:
             pass
         if new_context == "":
             new_context = "Could not find the results asked for"
-        return trim_to_max_tokens(new_context, settings['max_tokens'])
+        return select_passages(new_context, question, settings['max_tokens'])
     if direct:
-        return str("\nHere is information about " + string + " found online: " + search_string(string, settings))
+        return str("\nHere is information about " + string + " found online: " + search_string(string, settings, question or string))
     else:
         interfering_symbols = ['\"', '\'']
         commands = ['search']
@@ -579,12 +1893,383 @@ def search_routine(string, settings, direct=False):
                 instruction = string.split('Search',1)[0]
                 search_command = string.split('Search',1)[1]
             subject = search_command.split('for',1)[1].lstrip()
-            return str(instruction + "\nHere is information about " + subject + " found online: " + search_string(subject, settings))
+            return str(instruction + "\nHere is information about " + subject + " found online: " + search_string(subject, settings, string))
         else:
             return string
 
+# This function adds online context to a prompt: the content of the pages it links to, or else search results when a Searx instance is set, either for the prompt itself or, in the interactive prompt, for the (search:term) markers it starts with. Results for any extra search terms are added last. The context_budget of the prompt is shared evenly between the pages or searches.
+@metered('context')
+def add_online_context(user_message, settings, interactive=False, search_terms=None):
+    extracted_urls = extract_url(user_message)
+    sources = max(user_message.count("(search:"), 1) + len(search_terms or [])
+    budget = context_budget(user_message, settings)
+    if budget <= 0:
+        print("The prompt leaves no room in the context window for web content")
+    settings = dict(settings, max_tokens=max(budget // sources, 0))
+    # Passages are always ranked against the question as asked, not the context added to it along the way
+    question = user_message
+    if len(extracted_urls) > 0:
+        pages = fetch_concurrently([(url, lambda url, deadline: expand_url(url, settings['max_tokens'], deadline)) for url in extracted_urls[:settings['max_urls']]])
+        user_message = user_message + "\nHere is the content of the linked pages: " + select_passages("\n".join(pages), question, settings['max_tokens'])
+    else:
+        if settings['searx_url'] != "n":
+            if interactive and ("(search:" in user_message and ")" in user_message):
+                marked_terms = re.findall(r"(?<=\(search:)(.*?)(?=\))", user_message)
+                user_message = user_message.rsplit(")",1)[1] 
+                question = user_message
+                for s in marked_terms:
+                    user_message = user_message + search_routine(s, settings, True, question)
+            else:
+                user_message = search_routine(user_message, settings)
+    if search_terms:
+        for s in search_terms:
+            user_message = user_message + search_routine(s, settings, True, question)
+    return user_message
+
+# Take the web content added by add_online_context back out of a prompt, leaving the question and a note of what was looked up.
+def strip_online_context(question):
+    def note(match):
+        if match.group(2) is not None:
+            return "\n(Left out: information about " + match.group(2) + " found online)"
+        return "\n(Left out: the content of the linked pages)"
+    return re.sub(r"\nHere is (information about (.*?) found online|the content of the linked pages): .*?(?=\nHere is information about |\Z)", note, question, flags=re.DOTALL)
+
+# This coroutine asks the endpoint to summarize a transcript. It keeps its attempts and timings in stats of its own, out of the response_stats and metrics of the prompt being answered meanwhile, and the summary is never cached.
+async def request_summary(transcript, settings):
+    metrics_muted.set(True)
+    endpoint, data = build_request([], transcript, settings, "instruct", False)
+    answer_json = await send_request_async(settings, endpoint, data, read_batch_response, False, dict())
+    return choice_text(answer_json['choices'][0])
+
+# This function compacts a chat history that has grown past history_summary_tokens, keeping the last history_keep_turns exchanges as they are. The web content is stripped from the older exchanges, which are then summarized by the endpoint into a single exchange; if that fails, the stripped exchanges are kept instead. The compacted history replaces the older exchanges in memory and in the history journal, where earlier records that weren't loaded are left alone.
+def summarize_history(chat_history, settings):
+    # This runs while the next prompt is answered: it keeps out of that prompt's metrics, and doesn't print, as its output would land in the middle of the prompt, or go to another client of the daemon
+    metrics_muted.set(True)
+    try:
+        count = len(chat_history) - history_keep_turns
+        older = [make_history_entry(strip_online_context(question), answer) for question, answer, tokens in chat_history[:count]]
+        transcript = "\n\n".join("User: " + question + "\nAssistant: " + answer for question, answer, tokens in older)
+        limit = settings['context_tokens'] - settings['response_tokens'] - count_tokens(history_summary_system) - 2 * message_token_overhead
+        transcript = trim_to_max_tokens(transcript, max(limit, 0), True, True)
+        summary_settings = dict(settings, system=history_summary_system)
+        try:
+            summary = run_async(request_summary(transcript, summary_settings))
+            if summary:
+                older = [make_history_entry(history_summary_question, summary)]
+        except Exception:
+            pass
+        with history_lock:
+            if settings['history'] != "n" and settings['history'] != "":
+                with open(settings['history'], 'r', encoding='utf-8') as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+                position = len(records) - len(chat_history)
+                if position >= 0:
+                    rewrite_history(records[:position] + older + records[position + count:], settings['history'])
+            chat_history[:count] = older
+            if settings['history'] in loaded_histories:
+                remember_history(settings['history'], chat_history)
+    except Exception:
+        pass
+
+# Start compacting the chat history in a background thread once it holds more than history_summary_tokens, unless it is being compacted already. Returns the thread, if any.
+def compact_chat_history(chat_history, settings):
+    global history_compactor
+    if history_summary_tokens <= 0 or len(chat_history) <= history_keep_turns + 1:
+        return None
+    if sum(entry[2] for entry in chat_history) <= history_summary_tokens:
+        return None
+    if history_compactor is not None and history_compactor.is_alive():
+        return None
+    history_compactor = threading.Thread(target=summarize_history, args=(chat_history, settings), daemon=True)
+    history_compactor.start()
+    return history_compactor
+
+def read_batch_response(response, chunks, started):
+    response.raise_for_status()
+    return response.json()
+
+# Read a line of a batch file into its prompt: the JSON value if it parses, or else the line itself. Blank lines hold no prompt.
+def parse_batch_line(line):
+    if line.strip() == "":
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return line.rstrip("\n")
+
+# A prompt line is either a JSON string or an object with a "prompt" and optionally an "id", a "mode" and a "system" prompt overriding the settings. Give it as an object.
+def batch_record(record):
+    if not isinstance(record, dict):
+        return {'prompt': record}
+    return record
+
+# The settings and mode to send a batch prompt with.
+def batch_prompt_settings(record, settings):
+    prompt_settings = dict(settings)
+    if record.get('system'):
+        prompt_settings['system'] = record['system']
+    return prompt_settings, record.get('mode', settings['mode'])
+
+# This function sends a single batch prompt and returns its result record.
+async def run_batch_prompt(index, record, settings, limit):
+    import asyncio
+    record = batch_record(record)
+    prompt_settings, mode = batch_prompt_settings(record, settings)
+    result = {'index': index, 'id': record.get('id', index)}
+    stats = dict()
+    async with limit:
+        try:
+            endpoint, data = build_request([], str(record['prompt']), prompt_settings, mode, False)
+            started = time.perf_counter()
+            key = response_cache_key([], prompt_settings, mode, endpoint, data)
+            cached = await asyncio.to_thread(cache_lookup, 'response', key, cache_response_ttl, 'response_') if key else None
+            if cached:
+                result['response'] = cached[0]
+                result['tokens'] = 0
+                result['cached'] = True
+            else:
+                if current_metrics() is not None:
+                    add_metric('tokens_in', request_tokens(data))
+                with StageTimer('generation'):
+                    answer_json = await send_request_async(settings, endpoint, data, read_batch_response, False, stats)
+                result['response'] = choice_text(answer_json['choices'][0])
+                result['tokens'] = (answer_json.get('usage') or {}).get('completion_tokens') or 0
+                add_metric('tokens_out', result['tokens'])
+                if key and result['response']:
+                    await asyncio.to_thread(cache_store, 'response', key, result['response'])
+            result['seconds'] = round(time.perf_counter() - started, 3)
+        except Exception as e:
+            result['error'] = str(e)
+    result['attempts'] = stats.get('attempts', 0)
+    return result
+
+# Collect the ids already written to a batch output file, so a resumed batch skips them.
+def read_batch_checkpoint(file):
+    done = set()
+    try:
+        with open(file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if 'error' not in result:
+                    done.add(json.dumps(result['id']))
+    except FileNotFoundError:
+        pass
+    return done
+
+# This function sends every prompt of a JSONL file, or of stdin if the file is "-", to the endpoint on the shared event loop with at most concurrency requests in flight, and writes a JSON line for each result as soon as it can: right away in "completion" order, or once all earlier prompts are done in "input" order. Prompts are read as they are needed, so the input can be a pipe of any length. When resuming, prompts whose id already has a result in the output file are skipped.
+def run_batch(settings, source, output, concurrency, order, resume):
+    import asyncio
+    import concurrent.futures
+    global http_pool_size
+    http_pool_size = max(http_pool_size, concurrency)
+    done = read_batch_checkpoint(output) if resume and output else set()
+    if settings['model'] != "n":
+        enforce_model(settings, False, rank_backends(settings)[0]['url'])
+    source_file = sys.stdin if source == "-" else open(source, 'r', encoding='utf-8')
+    output_file = open(output, 'a' if resume else 'w', encoding='utf-8') if output else sys.stdout
+    totals = {'prompts': 0, 'errors': 0, 'skipped': 0, 'tokens': 0}
+    waiting = dict()
+    next_index = 0
+    def write(result):
+        totals['prompts'] += 1
+        if 'error' in result:
+            totals['errors'] += 1
+        totals['tokens'] += result.get('tokens', 0)
+        output_file.write(json.dumps(result) + "\n")
+        output_file.flush()
+    def collect(finished):
+        nonlocal next_index
+        for future in finished:
+            result = future.result()
+            if order == "completion":
+                write(result)
+            else:
+                waiting[result['index']] = result
+        # Blank and skipped lines hold a None place, so input order doesn't wait for them
+        while order == "input" and next_index in waiting:
+            result = waiting.pop(next_index)
+            if result is not None:
+                write(result)
+            next_index += 1
+    begin_metrics()
+    started = time.perf_counter()
+    pending = set()
+    limit = asyncio.Semaphore(concurrency)
+    for index, line in enumerate(source_file):
+        record = parse_batch_line(line)
+        if record is not None:
+            if json.dumps(batch_record(record).get('id', index)) in done:
+                totals['skipped'] += 1
+                record = None
+        if record is None:
+            if order == "input":
+                waiting[index] = None
+            collect([])
+            continue
+        pending.add(asyncio.run_coroutine_threadsafe(run_batch_prompt(index, record, settings, limit), get_event_loop()))
+        if len(pending) >= concurrency * 2:
+            finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(finished)
+    while len(pending) > 0:
+        finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        collect(finished)
+    elapsed = time.perf_counter() - started
+    if source_file is not sys.stdin:
+        source_file.close()
+    if output_file is not sys.stdout:
+        output_file.close()
+    finish_metrics('batch')
+    print("Batch finished: " + str(totals['prompts']) + " prompts (" + str(totals['errors']) + " errors, " + str(totals['skipped']) + " skipped) in " + str(round(elapsed, 1)) + "s, "
+          + str(round(totals['prompts'] / elapsed, 2) if elapsed > 0 else 0) + " prompts/s, "
+          + str(round(totals['tokens'] / elapsed, 1) if elapsed > 0 else 0) + " tokens/s", file=sys.stderr)
+
+# Read the combinations to compare prompts on, separated by ";". Each is written like an entry of the backends, a URL followed by "|" and the comma separated models and by another "|" and the presets, and stands for every one of its models with every one of its presets on that endpoint. Missing fields are taken from the settings.
+def parse_fanout(string, settings):
+    import urllib.parse
+    combinations = []
+    seen = set()
+    for entry in string.split(";"):
+        if entry.strip() == "":
+            continue
+        fields = [field.strip() for field in entry.split("|")] + ["", ""]
+        url = fields[0].rstrip("/") or settings['url']
+        models = [model.strip() for model in fields[1].split(",") if model.strip()] or [settings['model']]
+        presets = [preset.strip() for preset in fields[2].split(",") if preset.strip()] or [settings['preset']]
+        for model in models:
+            for preset in presets:
+                if (url, model, preset) in seen:
+                    continue
+                seen.add((url, model, preset))
+                combinations.append({
+                    'label': (model if model != "n" else "loaded model") + "/" + preset + "@" + (urllib.parse.urlparse(url).netloc or url),
+                    'settings': dict(settings, url=url, model=model, preset=preset, backends=[{'url': url, 'models': [], 'presets': []}]),
+                    'load': 0,
+                })
+    return combinations
+
+# Group the combinations by endpoint, and on each endpoint by model, in the order they are run so each model is loaded at most once: those using whatever model is loaded ("n") first, then the model the endpoint is known to have loaded, then the others in the order given.
+def schedule_fanout(combinations):
+    schedule = dict()
+    for combination in combinations:
+        groups = schedule.setdefault(combination['settings']['url'], dict())
+        groups.setdefault(combination['settings']['model'], []).append(combination)
+    capabilities = read_capabilities()
+    for url, groups in schedule.items():
+        loaded = (model_state.get(url) or {}).get('model') or (capabilities.get(url) or {}).get('model_name')
+        schedule[url] = sorted(groups.values(), key=lambda group: (group[0]['settings']['model'] != "n", group[0]['settings']['model'] != loaded))
+    return schedule
+
+# Print text with every line behind the label of its combination, so answers arriving together stay apart.
+def write_labeled(label, text):
+    with fanout_lock:
+        for line in text.split("\n"):
+            sys.stdout.write("[" + label + "] " + line + "\n")
+        sys.stdout.flush()
+
+# Print a streamed fan-out answer line by line behind its label as it arrives, and return it with its timing in stats.
+def read_fanout_stream(label, stats, response, chunks, started):
+    response.raise_for_status()
+    return stream_response(response, chunks, started, sink=functools.partial(write_labeled, label), stats=stats)
+
+# This coroutine sends one prompt, a string or an object like a batch prompt line, to one combination and returns its result record. The preset is sent along with the request, so presets of the same model are compared without loading it again. The response cache is not used, every answer is timed live.
+async def run_fanout_prompt(combination, index, record, limit):
+    record = batch_record(record)
+    prompt_settings, mode = batch_prompt_settings(record, combination['settings'])
+    result = {'combination': combination['label'], 'index': index, 'id': record.get('id', index)}
+    stats = dict()
+    async with limit:
+        try:
+            endpoint, data = build_request([], str(record['prompt']), prompt_settings, mode, True)
+            data['preset'] = prompt_settings['preset']
+            answer = await send_request_async(prompt_settings, endpoint, data, functools.partial(read_fanout_stream, combination['label'], stats), True, stats)
+            # Seconds to the first token and in total are from when the request was sent
+            result.update({
+                'response': answer,
+                'ttft': round(stats['ttft'], 3),
+                'seconds': round(stats['total'], 3),
+                'tokens': stats['tokens'],
+                'tokens_per_second': round(stats['tokens_per_second'], 1),
+                'length': len(answer),
+            })
+        except Exception as e:
+            result['error'] = str(e)
+            write_labeled(combination['label'], f"Error generating response: {str(e)}")
+    result['attempts'] = stats.get('attempts', 0)
+    return result
+
+# This coroutine runs every prompt on the combinations of one endpoint, one model after the other as scheduled, with at most concurrency prompts in flight. The time taken to load each model is noted on its combinations and kept out of their answer timings. When a model can't be loaded, its prompts aren't sent, so no answer from another model is taken for its own, and each is recorded as an error.
+async def run_fanout_backend(groups, records, concurrency):
+    import asyncio
+    results = []
+    for group in groups:
+        settings = group[0]['settings']
+        if settings['model'] != "n":
+            started = time.perf_counter()
+            await asyncio.to_thread(enforce_model, settings, False, settings['url'])
+            for combination in group:
+                combination['load'] = time.perf_counter() - started
+            if (model_state.get(settings['url']) or {}).get('model') != settings['model']:
+                error = "Could not load model " + settings['model']
+                for combination in group:
+                    write_labeled(combination['label'], f"Error generating response: {error}")
+                    for index, record in enumerate(records):
+                        results.append({'combination': combination['label'], 'index': index, 'id': batch_record(record).get('id', index), 'error': error, 'attempts': 0})
+                continue
+        limit = asyncio.Semaphore(concurrency)
+        results += await asyncio.gather(*[run_fanout_prompt(combination, index, record, limit) for combination in group for index, record in enumerate(records)])
+    return results
+
+# Print the average timing and length of the answers of each combination side by side.
+def print_fanout_table(combinations, results):
+    rows = [["combination", "prompts", "errors", "load (s)", "ttft (s)", "total (s)", "tokens/s", "tokens", "chars"]]
+    for combination in combinations:
+        finished = [result for result in results if result['combination'] == combination['label']]
+        answered = [result for result in finished if 'error' not in result]
+        def mean(key):
+            return sum(result[key] for result in answered) / len(answered) if answered else 0
+        rows.append([combination['label'], str(len(finished)), str(len(finished) - len(answered)), f"{combination['load']:.2f}",
+                     f"{mean('ttft'):.2f}", f"{mean('seconds'):.2f}", f"{mean('tokens_per_second'):.1f}", f"{mean('tokens'):.0f}", f"{mean('length'):.0f}"])
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    print()
+    for row in rows:
+        print("  ".join(cell.ljust(widths[column]) if column == 0 else cell.rjust(widths[column]) for column, cell in enumerate(row)))
+
+# This function sends the same prompts to every combination of endpoint, model and preset in fanout and compares their answers. Endpoints are run at the same time, each working through its models one after the other so none is loaded back and forth, and the presets of a model at the same time. Answers are printed as they stream in behind the label of their combination, written to output as JSON lines if given, and summed up in a table at the end.
+def run_fanout(settings, fanout, records, output, concurrency):
+    import asyncio
+    global http_pool_size
+    combinations = parse_fanout(fanout, settings)
+    schedule = schedule_fanout(combinations)
+    http_pool_size = max(http_pool_size, concurrency)
+    async def run_backends():
+        return await asyncio.gather(*[run_fanout_backend(groups, records, concurrency) for groups in schedule.values()])
+    results = [result for backend_results in run_async(run_backends()) for result in backend_results]
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    print_fanout_table(combinations, results)
+
+# Read the prompts to fan out: the one given on the command line with its online context, or the lines of a batch file, or of stdin if it is "-".
+def read_fanout_prompts(settings):
+    if args.prompt:
+        user_message = " ".join([args.prompt] + (args.rest or []))
+        return [add_online_context(user_message, settings, False, args.search)]
+    records = []
+    source_file = sys.stdin if args.batch == "-" else open(args.batch, 'r', encoding='utf-8')
+    for line in source_file:
+        record = parse_batch_line(line)
+        if record is not None:
+            records.append(record)
+    if source_file is not sys.stdin:
+        source_file.close()
+    return records
+
 def argument_parsing(new_default):
-    boolkeys = ['enforce', 'streaming']
+    boolkeys = ['enforce', 'streaming', 'preload']
     antiboolkeys = ['no_enforce', 'no_streaming']
     for key in new_default:
        if args.__getattribute__(key):
@@ -604,15 +2289,22 @@ def argument_parsing(new_default):
                 new_default['streaming'] = "n"
     return new_default
 
-if args.prompt:
+# This function answers the prompt given on the command line and exits, saving it to the history in "chat" mode.
+def run_single_prompt():
+    global history
     settings = initialize_settings("n", argument_parsing(default))
+    open_cache(settings['cache'])
+    begin_metrics()
 
+    if settings['preload']:
+        preload_model(settings)
     user_message = ""
     url = ""
+    history = []
     if settings['mode'] == "chat":
         if settings['history'] != "n":
             try:
-                history = read_history(settings['history'])
+                history = load_history(settings)
             except:
                 pass
     user_message = args.prompt
@@ -620,91 +2312,248 @@ if args.prompt:
         for arg in args.rest:
             user_message = user_message + " " + arg
 
-    extracted_urls = extract_url(user_message)
-    if len(extracted_urls) > 0:
-        i = 0
-        for url in extracted_urls:
-            if i < settings['max_urls']:
-                user_message = user_message + "\n" + expand_url(url)
-            i = i + 1
-    else:
-        if settings['searx_url'] != "n":
-            user_message = search_routine(user_message, settings)
-    if args.search:
-        for s in args.search:
-            user_message = user_message + search_routine(s, settings, True)
-    if settings['streaming']:
-        assistant_message = generate_streaming_response(history, user_message, settings, settings['mode'])
-    else:
-        assistant_message = generate_ai_response(history, user_message, settings, settings['mode'])
-    if settings['mode'] == "chat":
-        history.append((user_message, assistant_message))
-        if settings['history'] != "n":
-            write_history(history,settings['history'])
-    if settings['streaming']:
-        output_result(assistant_message, settings['printer'], False)
-    else:
+    user_message, assistant_message = answer_prompt(history, user_message, settings, False, args.search)
+    if settings['mode'] == "chat" and assistant_message is not None:
+        with history_lock:
+            history.append(make_history_entry(user_message, assistant_message))
+            if settings['history'] != "n":
+                append_history(history[-1], settings['history'])
+                remember_history(settings['history'], history)
+    if not settings['streaming']:
         output_result(assistant_message, settings['printer'])
+    finish_metrics('prompt')
+    if settings['mode'] == "chat":
+        compact_chat_history(history, settings)
 
-if not args.prompt:
-# This code initializes the user interface, retrieves the user's settings, and resets the screen. 
+def forwarded_variable(key):
+    return key.startswith("PYPROMPT_") or key.startswith("OPENAI_")
 
-    if args.direct:
-        reset_screen()
-        settings = initialize_settings("n", argument_parsing(default))
-    else:
-        change_options = start_interface(argument_parsing(default))
-        settings = initialize_settings(change_options, argument_parsing(default))
+# What the daemon writes for a client goes back over the socket in frames: a byte for the channel, 1 for stdout or 2 for stderr, the length of the data as four bytes and the data. A client that has gone away is ignored, so threads still writing for it aren't stopped.
+class DaemonChannel(io.RawIOBase):
+    def __init__(self, stream, channel, lock):
+        self.stream = stream
+        self.channel = channel
+        self.lock = lock
 
-    if settings['history'] != "n":
-        try:
-            history = read_history(settings['history'])
-        except:
-            pass
-    reset_screen()
+    def writable(self):
+        return True
+
+    def write(self, data):
+        import struct
+        with self.lock:
+            try:
+                self.stream.write(struct.pack(">BI", self.channel, len(data)) + bytes(data))
+                self.stream.flush()
+            except OSError:
+                pass
+        return len(data)
 
-    # This code snippet is a simple chatbot that takes user input, generates an AI response, and outputs the result. It continues to do so indefinitely until the program is terminated. The chatbot stores the conversation history if the mode is set to "chat". 
+# Copy the frames sent back by the daemon to stdout and stderr as they arrive.
+def read_daemon_frames(client):
+    import struct
+    buffer = b""
+    channels = {1: sys.stdout.buffer, 2: sys.stderr.buffer}
     while True:
-        user_message = input("> ")
-        if user_message == "(quit)":
+        data = client.recv(65536)
+        if not data:
+            break
+        buffer += data
+        while len(buffer) >= 5:
+            channel, length = struct.unpack(">BI", buffer[:5])
+            if len(buffer) < 5 + length:
+                break
+            channels.get(channel, sys.stdout.buffer).write(buffer[5:5 + length])
+            channels.get(channel, sys.stdout.buffer).flush()
+            buffer = buffer[5 + length:]
+
+def run_daemon_request(request, stream):
+    global args, default
+    saved_environment = {key: value for key, value in os.environ.items() if forwarded_variable(key)}
+    saved_directory = os.getcwd()
+    saved_stdout = sys.stdout
+    saved_stderr = sys.stderr
+    lock = threading.Lock()
+    output = io.TextIOWrapper(DaemonChannel(stream, 1, lock), encoding='utf-8', write_through=True)
+    errors = io.TextIOWrapper(DaemonChannel(stream, 2, lock), encoding='utf-8', write_through=True)
+    try:
+        for key in saved_environment:
+            del os.environ[key]
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+        sys.stdout = output
+        sys.stderr = errors
+        args = parser.parse_args(request['argv'])
+        default = load_defaults()
+        load_environment()
+        configure_metrics(args)
+        run_single_prompt()
+    except SystemExit:
+        pass
+    except Exception as e:
+        print(f"Error answering prompt: {str(e)}")
+    finally:
+        output.flush()
+        errors.flush()
+        sys.stdout = saved_stdout
+        sys.stderr = saved_stderr
+        os.chdir(saved_directory)
+        for key in [key for key in os.environ if forwarded_variable(key)]:
+            del os.environ[key]
+        os.environ.update(saved_environment)
+        load_environment()
+
+# The daemon answers single prompts sent by later invocations over a Unix socket, keeping the tokenizer, connection pools, caches and history it has loaded between them. Requests are handled one at a time, each with the client's environment and arguments.
+def serve_daemon(path):
+    import socketserver
+    class DaemonRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            with daemon_lock:
+                run_daemon_request(request, self.wfile)
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        get_token_encoder()
+    except Exception as e:
+        print(f"Error loading tokenizer: {str(e)}")
+    # Only the user running the daemon may connect, requests carry their API keys
+    saved_umask = os.umask(0o077)
+    server = socketserver.ThreadingUnixStreamServer(path, DaemonRequestHandler)
+    os.umask(saved_umask)
+    print("Daemon listening on " + path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(path)
+
+# Send the command line and environment to a running daemon and copy its answer to stdout, and its warnings and metrics to stderr, as they stream back. Returns False when no daemon is listening, so the prompt can be answered in-process instead.
+def forward_to_daemon(path, argv):
+    if not os.path.exists(path):
+        return False
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return False
+    with client:
+        request = {
+            'argv': argv,
+            'env': {key: value for key, value in os.environ.items() if forwarded_variable(key)},
+            'cwd': os.getcwd(),
+        }
+        client.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        read_daemon_frames(client)
+    return True
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    default = load_defaults()
+    configure_metrics(args)
+
+    if args.daemon:
+        if args.metrics_port:
+            serve_metrics(args.metrics_port)
+        serve_daemon(daemon_socket)
+        sys.exit()
+
+    if args.prompt and not args.no_daemon and not args.fanout:
+        if forward_to_daemon(daemon_socket, sys.argv[1:]):
             sys.exit()
-        if user_message == "(continue)":
-            if settings['streaming']:
-                assistant_message = generate_streaming_response([], previous_message + "\n" + assistant_message, settings, "completion")
-                print("\n")
-            else:
-                assistant_message = generate_ai_response([], previous_message + "\n" + assistant_message, settings, "completion")
-                print("\n")
+
+    if args.cache_stats:
+        open_cache(argument_parsing(default)['cache'])
+        print_cache_stats()
+        sys.exit()
+
+    if args.fanout:
+        if not args.prompt and not args.batch:
+            print("Error: --fanout needs a prompt or a --batch file of prompts")
+            sys.exit(1)
+        settings = initialize_settings("n", argument_parsing(default))
+        open_cache(settings['cache'])
+        run_fanout(settings, args.fanout, read_fanout_prompts(settings), args.output, args.concurrency)
+        sys.exit()
+
+    if args.batch:
+        settings = initialize_settings("n", argument_parsing(default))
+        open_cache(settings['cache'])
+        run_batch(settings, args.batch, args.output, args.concurrency, args.order, args.resume)
+        sys.exit()
+
+    if args.prompt:
+        run_single_prompt()
+        if history_compactor is not None:
+            history_compactor.join()
+
+    if not args.prompt:
+    # This code initializes the user interface, retrieves the user's settings, and resets the screen. 
+
+        if args.direct:
+            reset_screen()
+            settings = initialize_settings("n", argument_parsing(default))
         else:
-            output_result(str("> " + user_message + "\n\n"), settings['printer'], False)
-            extracted_urls = extract_url(user_message)
-            if len(extracted_urls) > 0:
-                i = 0
-                for url in extracted_urls:
-                    if i < settings['max_urls']:
-                        user_message = user_message + "\n" + expand_url(url)
-                    i = i + 1
-            else:
-                if settings['searx_url'] != "n":
-                    if ("(search:" in user_message and ")" in user_message):
-                        search_terms = re.findall(r"(?<=\(search:)(.*?)(?=\))", user_message)
-                        user_message = user_message.rsplit(")",1)[1] 
-                        for s in search_terms:
-                            user_message = user_message + search_routine(s, settings, True)
-                    else:
-                        user_message = search_routine(user_message, settings)
+            change_options = start_interface(argument_parsing(default))
+            settings = initialize_settings(change_options, argument_parsing(default))
+        open_cache(settings['cache'])
+        if settings['preload']:
+            preload_model(settings)
+        if args.metrics_port:
+            serve_metrics(args.metrics_port)
 
-            if settings['streaming']:
-                assistant_message = generate_streaming_response(history, user_message, settings, settings['mode'])
-                print("\n")
+        if settings['history'] != "n":
+            try:
+                history = read_history(settings['history'], history_tail, settings['context_tokens'])
+            except:
+                pass
+        reset_screen()
+
+        # This code snippet is a simple chatbot that takes user input, generates an AI response, and outputs the result. It continues to do so indefinitely until the program is terminated. The chatbot stores the conversation history if the mode is set to "chat", where a continued answer is added to the exchange it continues.
+        previous_message = ""
+        assistant_message = None
+        continuation = None
+        continued_exchange = False
+        while True:
+            user_message = input("> ")
+            if user_message == "(quit)":
+                sys.exit()
+            begin_metrics()
+            if user_message == "(continue)":
+                if continuation is None:
+                    continuation = start_continuation(previous_message, assistant_message or "")
+                if settings['streaming']:
+                    assistant_message = generate_streaming_response([], continuation_prompt(continuation), settings, "completion")
+                    print("\n")
+                else:
+                    assistant_message = generate_ai_response([], continuation_prompt(continuation), settings, "completion")
+                    print("\n")
+                if assistant_message is not None:
+                    continuation = extend_continuation(continuation, assistant_message)
+                    if settings['mode'] == "chat" and continued_exchange:
+                        with history_lock:
+                            question, answer, tokens = history[-1]
+                            history[-1] = make_history_entry(question, answer + assistant_message, tokens + count_tokens(assistant_message))
+                            if settings['history'] != "n" and settings['history'] != "":
+                                replace_last_history(history[-1], settings['history'])
             else:
-                assistant_message = generate_ai_response(history, user_message, settings, settings['mode'])
-        if settings['mode'] == "chat":
-            history.append((user_message, assistant_message))
-        if settings['streaming']:
-            output_result(assistant_message, settings['printer'], False)
-        else:
-            output_result(assistant_message, settings['printer'])
-        if settings['history'] != "n" and settings['history'] != "":
-            write_history(history,settings['history'])
-        previous_message = user_message
+                output_result(str("> " + user_message + "\n\n"), settings['printer'], False)
+                user_message, assistant_message = answer_prompt(history, user_message, settings, True)
+                if settings['streaming']:
+                    print("\n")
+                previous_message = user_message
+                continuation = None
+                continued_exchange = False
+                if settings['mode'] == "chat" and assistant_message is not None:
+                    with history_lock:
+                        history.append(make_history_entry(user_message, assistant_message))
+                        if settings['history'] != "n" and settings['history'] != "":
+                            append_history(history[-1], settings['history'])
+                    continued_exchange = True
+                    compact_chat_history(history, settings)
+            if not settings['streaming']:
+                output_result(assistant_message, settings['printer'])
+            finish_metrics('continue' if user_message == "(continue)" else 'prompt')
@@ -0,0 +1,199 @@
+import contextlib
+import io
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import pyprompt
+
+
+# Build a PDF with one page of Helvetica text per string, small enough to write by hand
+def make_pdf(pages):
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(str(4 + 2 * i) + " 0 R" for i in range(len(pages)))
+    objects.append("<< /Type /Pages /Kids [" + kids + "] /Count " + str(len(pages)) + " >>")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for i, text in enumerate(pages):
+        stream = "BT /F1 12 Tf 72 720 Td (" + text + ") Tj ET"
+        objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents " + str(5 + 2 * i) + " 0 R >>")
+        objects.append("<< /Length " + str(len(stream)) + " >>\nstream\n" + stream + "\nendstream")
+    pdf = "%PDF-1.4\n"
+    offsets = []
+    for number, content in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += str(number) + " 0 obj\n" + content + "\nendobj\n"
+    xref = len(pdf)
+    pdf += "xref\n0 " + str(len(objects) + 1) + "\n0000000000 65535 f \n" + "".join("%010d 00000 n \n" % offset for offset in offsets)
+    pdf += "trailer\n<< /Size " + str(len(objects) + 1) + " /Root 1 0 R >>\nstartxref\n" + str(xref) + "\n%%EOF\n"
+    return pdf.encode('latin-1')
+
+
+PAGES = [
+    " ".join(["alpha"] * 100),
+    " ".join(["bravo"] * 100),
+    " ".join(["charlie"] * 100),
+]
+
+
+# Serves the sample PDF, as application/pdf unless the path starts with /download/, which serves it as application/octet-stream like many file servers do, and /download/binary, which serves a file that isn't a PDF at all
+class SampleHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b"\x00\x01 not a document" if self.path == "/download/binary" else make_pdf(PAGES)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream" if self.path.startswith("/download/") else "application/pdf")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        pass
+
+
+class PdfTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), SampleHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = "http://127.0.0.1:" + str(cls.server.server_port)
+        cls.url = cls.base + "/sample.pdf"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def expand(self, max_tokens=None):
+        with requests.get(self.url, stream=True) as response:
+            return pyprompt.expand_pdf(response, self.url, max_tokens)
+
+    def test_extracts_every_page_in_order(self):
+        text, complete = self.expand()
+        self.assertTrue(complete)
+        self.assertTrue(text.index("alpha") < text.index("bravo") < text.index("charlie"))
+        self.assertEqual(text.count("bravo"), 100)
+
+    def test_stops_once_max_tokens_is_filled(self):
+        # A page holds 599 characters, just short of the 600 that fill 100 tokens at max_chars_per_token
+        text, complete = self.expand(max_tokens=100)
+        self.assertFalse(complete)
+        self.assertIn("alpha", text)
+        self.assertIn("bravo", text)
+        self.assertNotIn("charlie", text)
+
+    def test_reads_all_pages_when_the_last_fills_max_tokens(self):
+        text, complete = self.expand(max_tokens=240)
+        self.assertTrue(complete)
+        self.assertIn("charlie", text)
+
+    def test_expand_url_reads_pdf_pages(self):
+        text = pyprompt.expand_url(self.url, 100)
+        self.assertIn("Content of " + self.url, text)
+        self.assertIn("bravo", text)
+        self.assertNotIn("charlie", text)
+
+    def test_expand_url_reads_pdf_named_in_its_path(self):
+        text = pyprompt.expand_url(self.base + "/download/paper.pdf")
+        self.assertIn("charlie", text)
+
+    def test_expand_url_reads_pdf_recognised_by_its_content(self):
+        text = pyprompt.expand_url(self.base + "/download/paper")
+        self.assertIn("charlie", text)
+
+    def test_expand_url_skips_other_binary_files(self):
+        text = pyprompt.expand_url(self.base + "/download/binary")
+        self.assertIn("not a web page but a application/octet-stream file", text)
+
+
+def stream_event(text):
+    return b"data: " + json.dumps({'choices': [{'delta': {'content': text}}]}).encode('utf-8') + b"\n\n"
+
+
+# The printer is stood in for by a FIFO, which like the DevTerm printer blocks its writer until something reads it
+@unittest.skipUnless(hasattr(os, 'mkfifo'), "needs FIFOs")
+class PrinterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.fifo = os.path.join(self.directory.name, "printer")
+        os.mkfifo(self.fifo)
+        self.saved = (pyprompt.printer_target, pyprompt.printer_queue_size, pyprompt.printer_flush_timeout)
+        pyprompt.printer_target = self.fifo
+        pyprompt.printer_queue = None
+        self.lines = queue.Queue()
+
+    def tearDown(self):
+        pyprompt.printer_target, pyprompt.printer_queue_size, pyprompt.printer_flush_timeout = self.saved
+        self.directory.cleanup()
+
+    def start_reader(self):
+        def read():
+            with open(self.fifo, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self.lines.put(line)
+        threading.Thread(target=read, daemon=True).start()
+
+    def read_lines(self, count):
+        return [self.lines.get(timeout=5) for _ in range(count)]
+
+    def wait_for_printer(self):
+        deadline = time.monotonic() + 5
+        while pyprompt.printer_queue.qsize() > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_streamed_answer_is_printed_line_by_line(self):
+        printed_early = []
+        def chunks():
+            yield stream_event("first li")
+            yield stream_event("ne\nsecond")
+            # The first line reaches the printer before the rest of the answer arrives
+            printed_early.append(self.lines.get(timeout=5))
+            yield stream_event(" line\nthird")
+            yield b"data: [DONE]\n\n"
+        self.start_reader()
+        with contextlib.redirect_stdout(io.StringIO()):
+            answer = pyprompt.stream_response(None, chunks(), time.perf_counter(), printer=True)
+        self.assertEqual(answer, "first line\nsecond line\nthird")
+        self.assertEqual(printed_early, ["first line\n"])
+        self.assertEqual(self.read_lines(2), ["second line\n", "third\n"])
+
+    def test_output_is_dropped_when_the_printer_falls_behind(self):
+        pyprompt.printer_queue_size = 2
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            pyprompt.send_to_printer("line 0\n")
+            # The printer thread holds line 0 while it waits for the FIFO to be read, so two more fit in the queue
+            self.wait_for_printer()
+            for i in range(1, 6):
+                pyprompt.send_to_printer("line " + str(i) + "\n")
+        self.assertEqual(stderr.getvalue().count("Printer is too far behind"), 3)
+        self.start_reader()
+        self.assertEqual(self.read_lines(3), ["line 0\n", "line 1\n", "line 2\n"])
+        self.assertRaises(queue.Empty, self.lines.get, timeout=0.3)
+
+    def test_flush_printer_waits_for_queued_output(self):
+        for i in range(3):
+            pyprompt.send_to_printer("line " + str(i) + "\n")
+        threading.Timer(0.3, self.start_reader).start()
+        pyprompt.flush_printer()
+        self.assertEqual(pyprompt.printer_queue.unfinished_tasks, 0)
+        self.assertEqual(self.read_lines(3), ["line 0\n", "line 1\n", "line 2\n"])
+
+    def test_flush_printer_gives_up_after_its_timeout(self):
+        pyprompt.printer_flush_timeout = 0.2
+        pyprompt.send_to_printer("line 0\n")
+        started = time.monotonic()
+        pyprompt.flush_printer()
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(pyprompt.printer_queue.unfinished_tasks, 1)
+        self.start_reader()
+        self.assertEqual(self.read_lines(1), ["line 0\n"])
+
+
+if __name__ == "__main__":
+    unittest.main()